@@ -0,0 +1,67 @@
+"""add taxonomy_state table
+
+Revision ID: 06defa57764f
+Revises: c41a46328d8d
+Create Date: 2026-10-17 09:12:31.402117
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "06defa57764f"
+down_revision: Union[str, Sequence[str], None] = "c41a46328d8d"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "taxonomy_state",
+        sa.Column("event_id", sa.Integer(), nullable=False),
+        sa.Column("tax_id", sa.Text(), nullable=False),
+        sa.Column("parent_id", sa.Text(), nullable=True),
+        sa.Column("event_name", sa.Text(), nullable=False),
+        sa.Column("valid_from", sa.DateTime(), nullable=False),
+        sa.Column("valid_to", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["event_id"],
+            ["taxonomy.id"],
+        ),
+        sa.PrimaryKeyConstraint("event_id"),
+    )
+
+    # backfill: each event is current until the tax ID's next event
+    op.execute(
+        """
+        INSERT INTO taxonomy_state
+        (event_id, tax_id, parent_id, event_name, valid_from, valid_to)
+        SELECT
+            id,
+            tax_id,
+            parent_id,
+            event_name,
+            version_date,
+            LEAD(version_date) OVER (PARTITION BY tax_id ORDER BY version_date, id)
+        FROM taxonomy
+        """
+    )
+
+    op.create_index(
+        "idx_state_tax_id_valid", "taxonomy_state", ["tax_id", "valid_from", "valid_to"]
+    )
+    op.create_index(
+        "idx_state_parent_id_valid", "taxonomy_state", ["parent_id", "valid_from", "valid_to"]
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("idx_state_parent_id_valid", "taxonomy_state")
+    op.drop_index("idx_state_tax_id_valid", "taxonomy_state")
+    op.drop_table("taxonomy_state")
@@ -0,0 +1,66 @@
+"""add name_search table
+
+Revision ID: 5a1e9c4b7d20
+Revises: 8f3c2b7d9e14
+Create Date: 2026-10-17 14:41:08.113954
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "5a1e9c4b7d20"
+down_revision: Union[str, Sequence[str], None] = "8f3c2b7d9e14"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "name_search",
+        sa.Column("id", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column("name", sa.Text(), nullable=False),
+        sa.Column("event_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["event_id"],
+            ["taxonomy.id"],
+        ),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("name"),
+    )
+    op.execute(
+        """
+        CREATE VIRTUAL TABLE name_search_fts
+        USING fts5(name, content='name_search', content_rowid='id')
+        """
+    )
+
+    # backfill: the most recent event of every name, numbered by (length, name)
+    op.execute(
+        """
+        INSERT INTO name_search (id, name, event_id)
+        SELECT
+            (LENGTH(name) << 32)
+                | (ROW_NUMBER() OVER (PARTITION BY LENGTH(name) ORDER BY name) - 1),
+            name,
+            event_id
+        FROM (
+            SELECT name, id AS event_id, MAX(version_date)
+            FROM taxonomy
+            WHERE name IS NOT NULL
+            GROUP BY name
+        )
+        """
+    )
+    op.execute("INSERT INTO name_search_fts(name_search_fts) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TABLE IF EXISTS name_search_fts")
+    op.drop_table("name_search")
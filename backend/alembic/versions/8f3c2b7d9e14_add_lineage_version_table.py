@@ -0,0 +1,38 @@
+"""add lineage_version table
+
+Revision ID: 8f3c2b7d9e14
+Revises: 06defa57764f
+Create Date: 2026-10-17 11:03:52.716320
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "8f3c2b7d9e14"
+down_revision: Union[str, Sequence[str], None] = "06defa57764f"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # populated by the loader, or for existing databases with:
+    #   ttm-rebuild --db-path events.db versions
+    # TimeMachine.get_versions falls back to replaying lineages while it's empty
+    op.create_table(
+        "lineage_version",
+        sa.Column("tax_id", sa.Text(), nullable=False),
+        sa.Column("version_date", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("tax_id", "version_date"),
+        sqlite_with_rowid=False,
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("lineage_version")
@@ -0,0 +1,251 @@
+"""store version ordinals
+
+Revision ID: a8c6e1d94f27
+Revises: f3a7d2c9b514
+Create Date: 2026-10-17 23:41:09.274815
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "a8c6e1d94f27"
+down_revision: Union[str, Sequence[str], None] = "f3a7d2c9b514"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SOURCE_COLUMNS = "id, path, version_date"
+TAXONOMY_COLUMNS = (
+    "id, taxonomy_source_id, event_name, {version}, tax_id, parent_id, rank, name, merged_into_id"
+)
+STATE_COLUMNS = "event_id, tax_id, parent_id, event_name, valid_from, valid_to"
+
+# the version of every date in taxonomy_source. datetime() normalizes the
+# stored dates, which were compared as strings before.
+VERSIONS = """(
+    SELECT datetime(version_date) AS version_date, version
+    FROM taxonomy_source
+    GROUP BY 1
+)"""
+
+# the date of every version, as stored in taxonomy_source
+VERSION_DATES = """(
+    SELECT version, MIN(version_date) AS version_date
+    FROM taxonomy_source
+    GROUP BY version
+)"""
+
+
+def _source_columns(with_version: bool) -> list[sa.Column]:
+    columns = [
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("path", sa.Text(), nullable=False),
+        sa.Column("version_date", sa.DateTime(), nullable=False),
+    ]
+    if with_version:
+        columns.append(sa.Column("version", sa.Integer(), nullable=False))
+    return columns
+
+
+def _taxonomy_columns(version: sa.Column) -> list[sa.Column]:
+    return [
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("taxonomy_source_id", sa.Integer(), nullable=False),
+        sa.Column("event_name", sa.Text(), nullable=False),
+        version,
+        sa.Column("tax_id", sa.Integer(), nullable=False),
+        sa.Column("parent_id", sa.Integer(), nullable=True),
+        sa.Column("rank", sa.Text(), nullable=True),
+        sa.Column("name", sa.Text(), nullable=True),
+        sa.Column("merged_into_id", sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(["taxonomy_source_id"], ["taxonomy_source.id"]),
+    ]
+
+
+def _state_columns(version_type: sa.types.TypeEngine) -> list[sa.Column]:
+    return [
+        sa.Column("event_id", sa.Integer(), nullable=False),
+        sa.Column("tax_id", sa.Integer(), nullable=False),
+        sa.Column("parent_id", sa.Integer(), nullable=True),
+        sa.Column("event_name", sa.Text(), nullable=False),
+        sa.Column("valid_from", version_type, nullable=False),
+        sa.Column("valid_to", version_type, nullable=True),
+        sa.ForeignKeyConstraint(["event_id"], ["taxonomy.id"]),
+        sa.PrimaryKeyConstraint("event_id"),
+    ]
+
+
+def _replace_table(table: str, columns: str, select: str) -> None:
+    # the new table is created as <table>_new. The old table is dropped before
+    # renaming so that foreign keys referencing it keep pointing to <table>.
+    op.execute(f"INSERT INTO {table}_new ({columns}) {select}")
+    op.drop_table(table)
+    op.rename_table(f"{table}_new", table)
+
+
+def _create_taxonomy_indexes(version: str) -> None:
+    op.create_index("idx_parent_id", "taxonomy", ["parent_id", version])
+    op.create_index(f"idx_name_{version}", "taxonomy", ["name", version])
+    op.create_index(
+        "idx_merged_into_id",
+        "taxonomy",
+        ["merged_into_id"],
+        sqlite_where=sa.text("merged_into_id IS NOT NULL"),
+    )
+    op.create_index(f"idx_{version}_tax_id", "taxonomy", [version, "tax_id"])
+
+
+def _replace_state_table(version: str, version_type: sa.types.TypeEngine) -> None:
+    # recomputed from the taxonomy table (see state.py)
+    op.create_table("taxonomy_state_new", *_state_columns(version_type))
+    _replace_table(
+        "taxonomy_state",
+        STATE_COLUMNS,
+        f"""SELECT id, tax_id, parent_id, event_name, {version},
+            LEAD({version}) OVER (PARTITION BY tax_id ORDER BY {version}, id)
+        FROM taxonomy
+        ORDER BY id""",
+    )
+    op.create_index(
+        "idx_state_tax_id_valid", "taxonomy_state", ["tax_id", "valid_from", "valid_to"]
+    )
+    op.create_index(
+        "idx_state_parent_id_valid", "taxonomy_state", ["parent_id", "valid_from", "valid_to"]
+    )
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # versions are numbered from 0 in date order. Taxdumps of the same date
+    # share a version.
+    op.create_table(
+        "taxonomy_source_new", *_source_columns(with_version=True), sa.PrimaryKeyConstraint("id")
+    )
+    _replace_table(
+        "taxonomy_source",
+        f"{SOURCE_COLUMNS}, version",
+        f"""SELECT {SOURCE_COLUMNS},
+            DENSE_RANK() OVER (ORDER BY datetime(version_date)) - 1
+        FROM taxonomy_source""",
+    )
+
+    # events keep their order: versions are in the same order as dates. The
+    # LEFT JOIN makes events without a taxonomy source fail the NOT NULL
+    # constraint instead of being dropped.
+    op.create_table(
+        "taxonomy_new",
+        *_taxonomy_columns(sa.Column("version", sa.Integer(), nullable=False)),
+        sa.PrimaryKeyConstraint("tax_id", "version", "id"),
+        sa.UniqueConstraint("id"),
+        sqlite_with_rowid=False,
+    )
+    _replace_table(
+        "taxonomy",
+        TAXONOMY_COLUMNS.format(version="version"),
+        f"""SELECT {TAXONOMY_COLUMNS.format(version="versions.version")}
+        FROM taxonomy
+        LEFT JOIN {VERSIONS} AS versions
+            ON versions.version_date = datetime(taxonomy.version_date)
+        ORDER BY tax_id, taxonomy.version_date, id""",
+    )
+    _create_taxonomy_indexes("version")
+
+    _replace_state_table("version", sa.Integer())
+
+    op.create_table(
+        "lineage_version_new",
+        sa.Column("tax_id", sa.Integer(), nullable=False),
+        sa.Column("version", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("tax_id", "version"),
+        sqlite_with_rowid=False,
+    )
+    _replace_table(
+        "lineage_version",
+        "tax_id, version",
+        f"""SELECT CAST(tax_id AS INTEGER), versions.version
+        FROM lineage_version
+        LEFT JOIN {VERSIONS} AS versions
+            ON versions.version_date = datetime(lineage_version.version_date)
+        ORDER BY 1, 2""",
+    )
+
+    op.create_table(
+        "tree_version_new",
+        sa.Column("version", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column("tax_ids", sa.LargeBinary(), nullable=False),
+        sa.Column("sizes", sa.LargeBinary(), nullable=False),
+        sa.Column("parent_offsets", sa.LargeBinary(), nullable=False),
+        sa.PrimaryKeyConstraint("version"),
+    )
+    _replace_table(
+        "tree_version",
+        "version, tax_ids, sizes, parent_offsets",
+        f"""SELECT versions.version, tax_ids, sizes, parent_offsets
+        FROM tree_version
+        LEFT JOIN {VERSIONS} AS versions
+            ON versions.version_date = datetime(tree_version.version_date)""",
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.create_table(
+        "tree_version_new",
+        sa.Column("version_date", sa.DateTime(), nullable=False),
+        sa.Column("tax_ids", sa.LargeBinary(), nullable=False),
+        sa.Column("sizes", sa.LargeBinary(), nullable=False),
+        sa.Column("parent_offsets", sa.LargeBinary(), nullable=False),
+        sa.PrimaryKeyConstraint("version_date"),
+    )
+    _replace_table(
+        "tree_version",
+        "version_date, tax_ids, sizes, parent_offsets",
+        f"""SELECT version_dates.version_date, tax_ids, sizes, parent_offsets
+        FROM tree_version
+        JOIN {VERSION_DATES} AS version_dates USING (version)""",
+    )
+
+    op.create_table(
+        "lineage_version_new",
+        sa.Column("tax_id", sa.Text(), nullable=False),
+        sa.Column("version_date", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("tax_id", "version_date"),
+        sqlite_with_rowid=False,
+    )
+    _replace_table(
+        "lineage_version",
+        "tax_id, version_date",
+        f"""SELECT CAST(tax_id AS TEXT), version_dates.version_date
+        FROM lineage_version
+        JOIN {VERSION_DATES} AS version_dates USING (version)""",
+    )
+
+    op.create_table(
+        "taxonomy_new",
+        *_taxonomy_columns(sa.Column("version_date", sa.DateTime(), nullable=False)),
+        sa.PrimaryKeyConstraint("tax_id", "version_date", "id"),
+        sa.UniqueConstraint("id"),
+        sqlite_with_rowid=False,
+    )
+    _replace_table(
+        "taxonomy",
+        TAXONOMY_COLUMNS.format(version="version_date"),
+        f"""SELECT {TAXONOMY_COLUMNS.format(version="version_dates.version_date")}
+        FROM taxonomy
+        JOIN {VERSION_DATES} AS version_dates USING (version)
+        ORDER BY tax_id, version, id""",
+    )
+    _create_taxonomy_indexes("version_date")
+
+    _replace_state_table("version_date", sa.DateTime())
+
+    op.create_table(
+        "taxonomy_source_new", *_source_columns(with_version=False), sa.PrimaryKeyConstraint("id")
+    )
+    _replace_table(
+        "taxonomy_source", SOURCE_COLUMNS, f"SELECT {SOURCE_COLUMNS} FROM taxonomy_source"
+    )
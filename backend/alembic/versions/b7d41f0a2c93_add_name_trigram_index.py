@@ -0,0 +1,33 @@
+"""add name_trigram index
+
+Revision ID: b7d41f0a2c93
+Revises: 5a1e9c4b7d20
+Create Date: 2026-10-17 16:05:27.540318
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "b7d41f0a2c93"
+down_revision: Union[str, Sequence[str], None] = "5a1e9c4b7d20"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute(
+        """
+        CREATE VIRTUAL TABLE name_trigram
+        USING fts5(name, content='name_search', content_rowid='id', tokenize='trigram')
+        """
+    )
+    op.execute("INSERT INTO name_trigram(name_trigram) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TABLE IF EXISTS name_trigram")
@@ -0,0 +1,28 @@
+"""add version_date index
+
+Revision ID: d2e8a6c15f47
+Revises: b7d41f0a2c93
+Create Date: 2026-10-17 17:32:44.906215
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "d2e8a6c15f47"
+down_revision: Union[str, Sequence[str], None] = "b7d41f0a2c93"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # events between two versions (TimeMachine.get_diff_page)
+    op.create_index("idx_version_date_tax_id", "taxonomy", ["version_date", "tax_id"])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("idx_version_date_tax_id", "taxonomy")
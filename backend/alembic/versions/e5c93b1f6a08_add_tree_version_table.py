@@ -0,0 +1,39 @@
+"""add tree_version table
+
+Revision ID: e5c93b1f6a08
+Revises: d2e8a6c15f47
+Create Date: 2026-10-17 19:12:08.341517
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "e5c93b1f6a08"
+down_revision: Union[str, Sequence[str], None] = "d2e8a6c15f47"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # populated by the loader, or for existing databases with:
+    #   ttm-rebuild --db-path events.db trees
+    # TimeMachine.get_tree builds trees from snapshots while it's empty
+    op.create_table(
+        "tree_version",
+        sa.Column("version_date", sa.DateTime(), nullable=False),
+        sa.Column("tax_ids", sa.LargeBinary(), nullable=False),
+        sa.Column("sizes", sa.LargeBinary(), nullable=False),
+        sa.Column("parent_offsets", sa.LargeBinary(), nullable=False),
+        sa.PrimaryKeyConstraint("version_date"),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("tree_version")
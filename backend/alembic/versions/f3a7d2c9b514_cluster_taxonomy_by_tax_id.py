@@ -0,0 +1,151 @@
+"""cluster taxonomy by tax_id
+
+Revision ID: f3a7d2c9b514
+Revises: e5c93b1f6a08
+Create Date: 2026-10-17 21:04:37.518392
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "f3a7d2c9b514"
+down_revision: Union[str, Sequence[str], None] = "e5c93b1f6a08"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+TAXONOMY_COLUMNS = (
+    "id, taxonomy_source_id, event_name, version_date, tax_id, parent_id, rank, name, "
+    "merged_into_id"
+)
+STATE_COLUMNS = "event_id, tax_id, parent_id, event_name, valid_from, valid_to"
+
+
+def _taxonomy_columns(id_type: sa.types.TypeEngine) -> list[sa.Column]:
+    return [
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("taxonomy_source_id", sa.Integer(), nullable=False),
+        sa.Column("event_name", sa.Text(), nullable=False),
+        sa.Column("version_date", sa.DateTime(), nullable=False),
+        sa.Column("tax_id", id_type, nullable=False),
+        sa.Column("parent_id", id_type, nullable=True),
+        sa.Column("rank", sa.Text(), nullable=True),
+        sa.Column("name", sa.Text(), nullable=True),
+        sa.Column("merged_into_id", id_type, nullable=True),
+        sa.ForeignKeyConstraint(["taxonomy_source_id"], ["taxonomy_source.id"]),
+    ]
+
+
+def _state_columns(id_type: sa.types.TypeEngine) -> list[sa.Column]:
+    return [
+        sa.Column("event_id", sa.Integer(), nullable=False),
+        sa.Column("tax_id", id_type, nullable=False),
+        sa.Column("parent_id", id_type, nullable=True),
+        sa.Column("event_name", sa.Text(), nullable=False),
+        sa.Column("valid_from", sa.DateTime(), nullable=False),
+        sa.Column("valid_to", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["event_id"], ["taxonomy.id"]),
+        sa.PrimaryKeyConstraint("event_id"),
+    ]
+
+
+def _replace_table(table: str, columns: str, select: str) -> None:
+    # the new table is created as <table>_new. The old table is dropped before
+    # renaming so that foreign keys referencing it keep pointing to <table>.
+    op.execute(f"INSERT INTO {table}_new ({columns}) {select}")
+    op.drop_table(table)
+    op.rename_table(f"{table}_new", table)
+
+
+def _create_state_indexes() -> None:
+    op.create_index(
+        "idx_state_tax_id_valid", "taxonomy_state", ["tax_id", "valid_from", "valid_to"]
+    )
+    op.create_index(
+        "idx_state_parent_id_valid", "taxonomy_state", ["parent_id", "valid_from", "valid_to"]
+    )
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # integer tax IDs in a WITHOUT ROWID table clustered on (tax_id,
+    # version_date): the history of a tax ID is one range of the primary key.
+    # Event IDs (referenced by taxonomy_state and name_search) are kept.
+    op.create_table(
+        "taxonomy_new",
+        *_taxonomy_columns(sa.Integer()),
+        sa.PrimaryKeyConstraint("tax_id", "version_date", "id"),
+        sa.UniqueConstraint("id"),
+        sqlite_with_rowid=False,
+    )
+    # inserted in primary key order; INTEGER affinity converts the tax IDs
+    _replace_table(
+        "taxonomy",
+        TAXONOMY_COLUMNS,
+        f"""SELECT {TAXONOMY_COLUMNS}
+        FROM taxonomy
+        ORDER BY CAST(tax_id AS INTEGER), version_date, id""",
+    )
+
+    # the primary key replaces idx_tax_id and idx_tax_id_version_date, and
+    # entries of idx_parent_id include it (i.e. the tax IDs of children).
+    # Secondary index entries hold the whole primary key rather than a rowid,
+    # so idx_name (unused: names are searched through name_search and
+    # name_fts) is dropped and idx_merged_into_id only covers merges.
+    op.create_index("idx_parent_id", "taxonomy", ["parent_id", "version_date"])
+    op.create_index("idx_name_version_date", "taxonomy", ["name", "version_date"])
+    op.create_index(
+        "idx_merged_into_id",
+        "taxonomy",
+        ["merged_into_id"],
+        sqlite_where=sa.text("merged_into_id IS NOT NULL"),
+    )
+    op.create_index("idx_version_date_tax_id", "taxonomy", ["version_date", "tax_id"])
+
+    op.create_table("taxonomy_state_new", *_state_columns(sa.Integer()))
+    _replace_table(
+        "taxonomy_state",
+        STATE_COLUMNS,
+        f"SELECT {STATE_COLUMNS} FROM taxonomy_state ORDER BY event_id",
+    )
+    _create_state_indexes()
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.create_table(
+        "taxonomy_new",
+        *_taxonomy_columns(sa.Text()),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    _replace_table(
+        "taxonomy",
+        TAXONOMY_COLUMNS,
+        """SELECT id, taxonomy_source_id, event_name, version_date, CAST(tax_id AS TEXT),
+            CAST(parent_id AS TEXT), rank, name, CAST(merged_into_id AS TEXT)
+        FROM taxonomy
+        ORDER BY id""",
+    )
+
+    op.create_index("idx_tax_id", "taxonomy", ["tax_id"])
+    op.create_index("idx_parent_id", "taxonomy", ["parent_id"])
+    op.create_index("idx_name", "taxonomy", [sa.text("lower(name)")])
+    op.create_index("idx_tax_id_version_date", "taxonomy", ["tax_id", "version_date"])
+    op.create_index("idx_name_version_date", "taxonomy", ["name", "version_date"])
+    op.create_index("idx_merged_into_id", "taxonomy", ["merged_into_id"])
+    op.create_index("idx_version_date_tax_id", "taxonomy", ["version_date", "tax_id"])
+
+    op.create_table("taxonomy_state_new", *_state_columns(sa.Text()))
+    _replace_table(
+        "taxonomy_state",
+        STATE_COLUMNS,
+        """SELECT event_id, CAST(tax_id AS TEXT), CAST(parent_id AS TEXT), event_name,
+            valid_from, valid_to
+        FROM taxonomy_state
+        ORDER BY event_id""",
+    )
+    _create_state_indexes()
@@ -1,14 +1,16 @@
+import hashlib
 import os
-import random
 import threading
 
 import marshmallow as ma
-from flask import Flask
+from flask import Flask, Response, request
 from flask.views import MethodView
 from flask_cors import CORS
-from flask_smorest import Api, Blueprint
+from flask_smorest import Api, Blueprint, abort
 
-from taxonomy_time_machine import TimeMachine
+from taxonomy_time_machine import MemoryTimeMachine, TimeMachine
+from taxonomy_time_machine.cache import shared_cache
+from taxonomy_time_machine.snapshot import FORMATS, format_snapshot
 
 app = Flask(__name__)
 
@@ -54,16 +56,71 @@ blp = Blueprint(
 
 DATABASE_PATH = os.environ.get("DATABASE_PATH", "events.db")
 
+# maximum number of items accepted by the batch endpoints
+MAX_BATCH_SIZE = int(os.environ.get("TTM_MAX_BATCH_SIZE", "50000"))
 
+# "sqlite" queries the database for every lookup, "memory" loads the taxonomy
+# table into a columnar in-memory store once (shared by all threads)
+ENGINE = os.environ.get("TTM_ENGINE", "sqlite")
+
+ENGINES = {"sqlite": TimeMachine, "memory": MemoryTimeMachine}
+
+if ENGINE not in ENGINES:
+    raise ValueError(f"Invalid TTM_ENGINE: {ENGINE} (expected one of: {', '.join(ENGINES)})")
+
+# open the database read-only with tuned pragmas (see connect_read_only). On
+# by default outside of development.
+READ_ONLY = os.environ.get("TTM_READ_ONLY", "0" if os.environ.get("FLASK_DEBUG") else "1") == "1"
+
+# how long browsers and proxies may reuse a response without revalidating it.
+# Responses only change when a new taxdump is loaded.
+CACHE_MAX_AGE = int(os.environ.get("TTM_CACHE_MAX_AGE", "300"))
+
+# GET endpoints whose responses are a function of the request and the data
+# version only (i.e. not /random-species)
+CACHEABLE_ENDPOINTS = {
+    "taxonomy.Search",
+    "taxonomy.Events",
+    "taxonomy.Children",
+    "taxonomy.Descendants",
+    "taxonomy.IsDescendant",
+    "taxonomy.Lineage",
+    "taxonomy.Versions",
+    "taxonomy.Diff",
+    "taxonomy.DiffSummary",
+}
+
+
+# SQLite connections can't be shared between threads, so each thread gets its
+# own TimeMachine. Query results are cached process-wide (see cache.py).
 _local = threading.local()
 
 
 def get_taxonomy():
     if not hasattr(_local, "taxonomy"):
-        _local.taxonomy = TimeMachine(database_path=DATABASE_PATH)
+        _local.taxonomy = ENGINES[ENGINE](database_path=DATABASE_PATH, read_only=READ_ONLY)
     return _local.taxonomy
 
 
+def warm_up():
+    """Load anything that is shared by all connections (e.g. the in-memory
+    event store) without keeping a connection open.
+
+    Called by gunicorn in the master process before forking workers, so that
+    workers share this memory copy-on-write (see gunicorn.conf.py).
+    """
+    taxonomy = ENGINES[ENGINE](database_path=DATABASE_PATH, read_only=READ_ONLY)
+    taxonomy.get_species_index()
+    taxonomy.conn.close()
+
+
+def reset_connections():
+    """Drop TimeMachines (and their SQLite connections) inherited from a
+    parent process. SQLite connections must not be used across fork()."""
+    global _local
+    _local = threading.local()
+
+
 class QueryArgsSchema(ma.Schema):
     query = ma.fields.String(
         metadata={
@@ -73,6 +130,25 @@ class QueryArgsSchema(ma.Schema):
     )
 
 
+class SearchBatchArgsSchema(ma.Schema):
+    queries = ma.fields.List(
+        ma.fields.String(),
+        required=True,
+        validate=ma.validate.Length(max=MAX_BATCH_SIZE),
+        metadata={
+            "description": "Search terms (taxon names or IDs)",
+            "example": ["Bacteroides dorei", "Homo sapiens"],
+        },
+    )
+    exact = ma.fields.Boolean(
+        load_default=True,
+        metadata={
+            "description": "Resolve exact name matches first and only fall back to fuzzy "
+            "matching for queries without an exact match",
+        },
+    )
+
+
 class TaxIdQuerySchema(ma.Schema):
     tax_id = ma.fields.Integer(metadata={"description": "NCBI Taxonomy ID", "example": 9606})
 
@@ -120,10 +196,206 @@ class TaxonSchema(ma.Schema):
     )
 
 
+class LineageBatchArgsSchema(ma.Schema):
+    tax_ids = ma.fields.List(
+        ma.fields.String(),
+        required=True,
+        validate=ma.validate.Length(max=MAX_BATCH_SIZE),
+        metadata={"description": "NCBI Taxonomy IDs", "example": ["9606", "821"]},
+    )
+    version_date = ma.fields.NaiveDateTime(
+        required=False,
+        allow_none=True,
+        metadata={
+            "description": "ISO8601-formatted datetime (e.g. 2014-08-01T00:00:00)",
+            "example": "2014-08-01T00:00:00",
+        },
+    )
+
+
+class LineageBatchSchema(ma.Schema):
+    tax_id = ma.fields.String(metadata={"description": "NCBI Taxonomy ID", "example": "9606"})
+    lineage = ma.fields.List(ma.fields.Nested(TaxonSchema))
+
+
+class LcaBatchArgsSchema(ma.Schema):
+    tax_id_sets = ma.fields.List(
+        ma.fields.List(ma.fields.String(), validate=ma.validate.Length(min=1)),
+        required=True,
+        validate=ma.validate.Length(max=MAX_BATCH_SIZE),
+        metadata={
+            "description": "Sets of NCBI Taxonomy IDs",
+            "example": [["9606", "10090"], ["821", "817", "562"]],
+        },
+    )
+    version_date = ma.fields.NaiveDateTime(
+        required=False,
+        allow_none=True,
+        metadata={
+            "description": "ISO8601-formatted datetime (e.g. 2014-08-01T00:00:00)",
+            "example": "2014-08-01T00:00:00",
+        },
+    )
+
+
+class LcaBatchSchema(ma.Schema):
+    tax_ids = ma.fields.List(ma.fields.String())
+    lca = ma.fields.String(
+        allow_none=True,
+        metadata={
+            "description": "Tax ID of the lowest common ancestor (null if any of the tax IDs "
+            "didn't exist at that time)",
+            "example": "314146",
+        },
+    )
+
+
+class SearchBatchSchema(ma.Schema):
+    query = ma.fields.String(
+        metadata={"description": "Search term", "example": "Bacteroides dorei"}
+    )
+    matches = ma.fields.List(ma.fields.Nested(TaxonSchema))
+
+
+class SnapshotArgsSchema(ma.Schema):
+    as_of = ma.fields.NaiveDateTime(
+        required=False,
+        allow_none=True,
+        metadata={
+            "description": "ISO8601-formatted datetime (e.g. 2014-08-01T00:00:00), defaults to "
+            "the latest version",
+            "example": "2014-08-01T00:00:00",
+        },
+    )
+    format = ma.fields.String(
+        load_default="tsv",
+        validate=ma.validate.OneOf(list(FORMATS)),
+        metadata={
+            "description": "tsv (tax_id, parent_id, rank, name) or NCBI-style nodes.dmp or "
+            "names.dmp lines",
+        },
+    )
+
+
+class DiffSummaryArgsSchema(ma.Schema):
+    from_date = ma.fields.NaiveDateTime(
+        data_key="from",
+        required=True,
+        metadata={
+            "description": "ISO8601-formatted datetime of the earlier version (exclusive)",
+            "example": "2014-08-01T00:00:00",
+        },
+    )
+    to_date = ma.fields.NaiveDateTime(
+        data_key="to",
+        required=True,
+        metadata={
+            "description": "ISO8601-formatted datetime of the later version (inclusive)",
+            "example": "2019-05-01T00:00:00",
+        },
+    )
+
+    @ma.validates_schema
+    def validate_range(self, data, **_):
+        if data["from_date"] >= data["to_date"]:
+            raise ma.ValidationError("must be later than from", field_name="to")
+
+
+class DiffArgsSchema(DiffSummaryArgsSchema):
+    after = ma.fields.String(
+        required=False,
+        metadata={"description": "Tax ID to continue after (`next` of the previous page)"},
+    )
+    limit = ma.fields.Integer(
+        load_default=1000,
+        validate=ma.validate.Range(min=1, max=MAX_BATCH_SIZE),
+        metadata={"description": "Number of tax IDs with events to read per page"},
+    )
+
+
+class ChangeSchema(ma.Schema):
+    event_name = ma.fields.String(
+        metadata={"description": "Net change (create, alter, delete or merge)"}
+    )
+    tax_id = ma.fields.String(metadata={"description": "NCBI Taxonomy ID", "example": "821"})
+    rank = ma.fields.String(allow_none=True)
+    before = ma.fields.Nested(
+        TaxonSchema, allow_none=True, metadata={"description": "State at the earlier version"}
+    )
+    after = ma.fields.Nested(
+        TaxonSchema, allow_none=True, metadata={"description": "State at the later version"}
+    )
+    changed_fields = ma.fields.List(
+        ma.fields.String(),
+        metadata={"description": "Fields that changed", "example": ["name", "parent_id"]},
+    )
+
+
+class DiffSchema(ma.Schema):
+    changes = ma.fields.List(ma.fields.Nested(ChangeSchema))
+    next = ma.fields.String(
+        allow_none=True,
+        metadata={"description": "Value of `after` for the next page (null on the last page)"},
+    )
+
+
+class DiffSummarySchema(ma.Schema):
+    rank = ma.fields.String(allow_none=True)
+    event_name = ma.fields.String()
+    count = ma.fields.Integer()
+
+
+class IsDescendantArgsSchema(ChildrenQuerySchema):
+    ancestor_id = ma.fields.String(
+        required=True, metadata={"description": "NCBI Taxonomy ID", "example": "9605"}
+    )
+
+
+class IsDescendantSchema(ma.Schema):
+    tax_id = ma.fields.String()
+    ancestor_id = ma.fields.String()
+    is_descendant = ma.fields.Boolean()
+
+
+class DescendantsArgsSchema(ChildrenQuerySchema):
+    after = ma.fields.String(
+        required=False,
+        metadata={"description": "Descendant to continue after (`next` of the previous page)"},
+    )
+    limit = ma.fields.Integer(
+        load_default=1000,
+        validate=ma.validate.Range(min=1, max=MAX_BATCH_SIZE),
+        metadata={"description": "Number of descendants per page"},
+    )
+
+
+class DescendantsSchema(ma.Schema):
+    tax_id = ma.fields.String()
+    descendants = ma.fields.List(
+        ma.fields.String(), metadata={"description": "Tax IDs of descendants, in preorder"}
+    )
+    next = ma.fields.String(
+        allow_none=True,
+        metadata={"description": "Value of `after` for the next page (null on the last page)"},
+    )
+
+
 class VersionSchema(ma.Schema):
     version_date = ma.fields.NaiveDateTime()
 
 
+class RandomSpeciesArgsSchema(ma.Schema):
+    min_event_count = ma.fields.Integer(
+        load_default=1,
+        validate=ma.validate.Range(min=1),
+        metadata={"description": "Only pick species with at least this many events", "example": 2},
+    )
+    changed_lineage = ma.fields.Boolean(
+        load_default=False,
+        metadata={"description": "Only pick species whose lineage has changed"},
+    )
+
+
 class RandomSpeciesResponseSchema(ma.Schema):
     tax_id = ma.fields.String(metadata={"description": "NCBI Taxonomy ID", "example": "9606"})
     name = ma.fields.String(metadata={"description": "Scientific name", "example": "Homo sapiens"})
@@ -146,6 +418,20 @@ class Search(MethodView):
         return matches
 
 
+@blp.route("/search/batch")
+class SearchBatch(MethodView):
+    @blp.arguments(SearchBatchArgsSchema)
+    @blp.response(200, SearchBatchSchema(many=True))
+    def post(self, args):
+        """Return the matching tax IDs for many names"""
+        db = get_taxonomy()
+        queries = args["queries"]
+
+        matches = db.search_names_batch(queries=queries, exact=args["exact"], limit=10)
+
+        return [{"query": query, "matches": matches[query]} for query in queries]
+
+
 @blp.route("/events")
 class Events(MethodView):
     @blp.arguments(TaxIdQuerySchema, location="query")
@@ -170,6 +456,46 @@ class Children(MethodView):
         return db.get_children(tax_id=tax_id, as_of=version)
 
 
+@blp.route("/descendants")
+class Descendants(MethodView):
+    @blp.arguments(DescendantsArgsSchema, location="query")
+    @blp.response(200, DescendantsSchema)
+    def get(self, args):
+        """Return the descendants of a given tax ID at a specific time, one page at a time"""
+        db = get_taxonomy()
+        tax_id = args["tax_id"]
+
+        try:
+            descendants, next_after = db.get_descendants_page(
+                tax_id=tax_id,
+                as_of=args.get("version_date"),
+                after=args.get("after"),
+                limit=args["limit"],
+            )
+        except ValueError as e:
+            abort(400, message=str(e))
+
+        return {"tax_id": tax_id, "descendants": descendants, "next": next_after}
+
+
+@blp.route("/is-descendant")
+class IsDescendant(MethodView):
+    @blp.arguments(IsDescendantArgsSchema, location="query")
+    @blp.response(200, IsDescendantSchema)
+    def get(self, args):
+        """Return whether a tax ID was a descendant of another at a specific time"""
+        db = get_taxonomy()
+        tax_id, ancestor_id = args["tax_id"], args["ancestor_id"]
+
+        return {
+            "tax_id": tax_id,
+            "ancestor_id": ancestor_id,
+            "is_descendant": db.is_descendant(
+                tax_id=tax_id, ancestor_id=ancestor_id, as_of=args.get("version_date")
+            ),
+        }
+
+
 @blp.route("/lineage")
 class Lineage(MethodView):
     # TODO: more generic name for schema
@@ -184,6 +510,88 @@ class Lineage(MethodView):
         return db.get_lineage(tax_id=tax_id, as_of=version)[::-1]
 
 
+@blp.route("/lineage/batch")
+class LineageBatch(MethodView):
+    @blp.arguments(LineageBatchArgsSchema)
+    @blp.response(200, LineageBatchSchema(many=True))
+    def post(self, args):
+        """Return the complete taxonomic lineages for many tax IDs at a specific time"""
+        db = get_taxonomy()
+        tax_ids = args["tax_ids"]
+        version = args.get("version_date")
+
+        lineages = db.get_lineages(tax_ids=tax_ids, as_of=version)
+
+        return [{"tax_id": tax_id, "lineage": lineages[tax_id][::-1]} for tax_id in tax_ids]
+
+
+@blp.route("/lca/batch")
+class LcaBatch(MethodView):
+    @blp.arguments(LcaBatchArgsSchema)
+    @blp.response(200, LcaBatchSchema(many=True))
+    def post(self, args):
+        """Return the lowest common ancestor of many sets of tax IDs at a specific time"""
+        db = get_taxonomy()
+        tax_id_sets = args["tax_id_sets"]
+
+        lcas = db.lca_batch(tax_id_sets=tax_id_sets, as_of=args.get("version_date"))
+
+        return [
+            {"tax_ids": tax_ids, "lca": lca} for tax_ids, lca in zip(tax_id_sets, lcas, strict=True)
+        ]
+
+
+@blp.route("/snapshot")
+class Snapshot(MethodView):
+    @blp.arguments(SnapshotArgsSchema, location="query")
+    @blp.response(200, content_type="text/tab-separated-values")
+    def get(self, args):
+        """Stream every taxon that existed at a specific time"""
+        db = get_taxonomy()
+        as_of = args.get("as_of")
+        format = args["format"]
+
+        version = as_of.date().isoformat() if as_of else "latest"
+        filename = f"{format}_{version}.dmp" if format in ("nodes", "names") else f"{version}.tsv"
+
+        return Response(
+            format_snapshot(db.iter_snapshot(as_of=as_of), format=format),
+            mimetype="text/tab-separated-values",
+            headers={"Content-Disposition": f"attachment; filename={filename}"},
+        )
+
+
+@blp.route("/diff")
+class Diff(MethodView):
+    @blp.arguments(DiffArgsSchema, location="query")
+    @blp.response(200, DiffSchema)
+    def get(self, args):
+        """Return the net changes of all taxa between two versions, one page at a time"""
+        db = get_taxonomy()
+
+        try:
+            changes, next_after = db.get_diff_page(
+                from_date=args["from_date"],
+                to_date=args["to_date"],
+                after=args.get("after"),
+                limit=args["limit"],
+            )
+        except ValueError as e:
+            abort(400, message=str(e))
+
+        return {"changes": changes, "next": next_after}
+
+
+@blp.route("/diff/summary")
+class DiffSummary(MethodView):
+    @blp.arguments(DiffSummaryArgsSchema, location="query")
+    @blp.response(200, DiffSummarySchema(many=True))
+    def get(self, args):
+        """Return the number of net changes between two versions by rank and type"""
+        db = get_taxonomy()
+        return db.get_diff_summary(from_date=args["from_date"], to_date=args["to_date"])
+
+
 @blp.route("/versions")
 class Versions(MethodView):
     @blp.arguments(ChildrenQuerySchema, location="query")
@@ -202,52 +610,70 @@ class Versions(MethodView):
 
 @blp.route("/random-species")
 class RandomSpecies(MethodView):
+    @blp.arguments(RandomSpeciesArgsSchema, location="query")
     @blp.response(200, RandomSpeciesResponseSchema)
-    def get(self):
+    def get(self, args):
         """Return a random species with taxonomic history"""
         db = get_taxonomy()
-        cursor = db.cursor
-
-        # Fast random selection using OFFSET with cached count
-        # Use hardcoded count for speed (approximately 874,797 as of last check)
-        # This doesn't need to be perfectly accurate for random selection
-        total_count = 870_000
-        random_offset = random.randint(0, total_count - 1)
-
-        # Get random species using OFFSET
-        cursor.execute(
-            """
-            SELECT tax_id, name
-            FROM taxonomy
-            WHERE rank = 'species'
-            LIMIT 1 OFFSET ?
-        """,
-            (random_offset,),
+
+        # species are sampled uniformly from an index built at startup
+        sample = db.get_species_index().sample(
+            min_event_count=args["min_event_count"],
+            changed_lineage=args["changed_lineage"],
         )
 
-        result = cursor.fetchone()
+        if sample is None:
+            abort(404, message="No species match the given filters")
 
-        # Get event count for the selected species
-        cursor.execute(
-            """
-            SELECT COUNT(*) as event_count
-            FROM taxonomy
-            WHERE tax_id = ?
-        """,
-            (result["tax_id"],),
-        )
+        tax_id, event_count = sample
+        name = next(e.name for e in reversed(db.get_events(tax_id=tax_id)) if e.name)
 
-        count_result = cursor.fetchone()
-        return {
-            "tax_id": result["tax_id"],
-            "name": result["name"],
-            "event_count": count_result["event_count"] if count_result else 1,
-        }
+        return {"tax_id": tax_id, "name": name, "event_count": event_count}
 
 
 api.register_blueprint(blp)
 
 
+def get_etag() -> str:
+    """ETag of all cacheable responses: changes whenever a new taxonomy source
+    is loaded (or the API version changes)"""
+    version = f"{app.config['API_VERSION']}:{get_taxonomy().data_version}"
+    return hashlib.sha1(version.encode()).hexdigest()[:20]
+
+
+def _is_cacheable() -> bool:
+    return request.method in ("GET", "HEAD") and request.endpoint in CACHEABLE_ENDPOINTS
+
+
+def _set_cache_headers(response):
+    response.set_etag(get_etag())
+    response.cache_control.public = True
+    response.cache_control.max_age = CACHE_MAX_AGE
+    return response
+
+
+@app.before_request
+def check_etag():
+    """Answer conditional requests for unchanged data without querying it"""
+    # compare weakly: nginx turns ETags into weak ones when it compresses
+    # responses
+    if _is_cacheable() and request.if_none_match.contains_weak(get_etag()):
+        return _set_cache_headers(app.response_class(status=304))
+
+
+@app.after_request
+def add_cache_headers(response):
+    if _is_cacheable() and response.status_code == 200:
+        _set_cache_headers(response)
+    return response
+
+
+@app.route("/cache-stats")
+def cache_stats():
+    """Hit/miss counters of the shared result cache (not part of the public API)"""
+    return shared_cache.stats()
+
+
 def main():
     app.run(host="0.0.0.0", port=9606)
 
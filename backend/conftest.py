@@ -6,13 +6,23 @@ from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 
+from taxonomy_time_machine.event_store import MemoryTimeMachine
+from taxonomy_time_machine.lineage_versions import rebuild_lineage_versions
 from taxonomy_time_machine.models import Base, Taxonomy, TaxonomySource
+from taxonomy_time_machine.name_search import (
+    CREATE_FTS_TABLE,
+    CREATE_TRIGRAM_TABLE,
+    rebuild_name_search,
+)
+from taxonomy_time_machine.state import rebuild_state_table
 from taxonomy_time_machine.time_machine import TimeMachine
+from taxonomy_time_machine.tree_versions import rebuild_tree_versions
 
 D1 = datetime(2014, 8, 1)
 D2 = datetime(2014, 9, 1)
 D3 = datetime(2019, 5, 1)
 D4 = datetime(2024, 12, 11)
+VERSION_DATES = [D1, D2, D3, D4]
 
 # Minimal dataset covering: search, deletion, moves, renames, lineage changes
 EVENTS = [
@@ -171,6 +181,39 @@ EVENTS = [
         "event_name": "alter",
         "version_date": D3,
     },
+    # Re-created node: 1101 created under 1100, deleted at D2, then re-created at D3
+    {
+        "tax_id": "1100",
+        "name": "RecreatedGenus",
+        "parent_id": "2",
+        "rank": "genus",
+        "event_name": "create",
+        "version_date": D1,
+    },
+    {
+        "tax_id": "1101",
+        "name": "RecreatedSpecies",
+        "parent_id": "1100",
+        "rank": "species",
+        "event_name": "create",
+        "version_date": D1,
+    },
+    {
+        "tax_id": "1101",
+        "name": None,
+        "parent_id": "1100",
+        "rank": None,
+        "event_name": "delete",
+        "version_date": D2,
+    },
+    {
+        "tax_id": "1101",
+        "name": "RecreatedSpecies",
+        "parent_id": "1100",
+        "rank": "species",
+        "event_name": "create",
+        "version_date": D3,
+    },
     # Moved node: 2002 created under 2000, then moved to 2001 at D2
     {
         "tax_id": "2000",
@@ -258,8 +301,14 @@ EVENTS = [
 ]
 
 
-@pytest.fixture(scope="session")
-def db():
+# tables maintained by the loader that TimeMachine uses when they're present
+DERIVED_TABLES = ["taxonomy_state", "lineage_version", "name_search", "tree_version"]
+
+
+# legacy: only the taxonomy table, sqlite: taxonomy + derived tables,
+# memory: in-memory event store
+@pytest.fixture(scope="session", params=["legacy", "sqlite", "memory"])
+def db(request):
     # Single raw connection shared between SQLAlchemy (for setup) and TimeMachine (for queries)
     raw_conn = sqlite3.connect(":memory:")
     raw_conn.row_factory = sqlite3.Row
@@ -273,11 +322,23 @@ def db():
 
     Session = sessionmaker(bind=engine)
     with Session() as session:
-        source = TaxonomySource(path="test-fixture", version_date=D1)
-        session.add(source)
+        # one taxonomy source per version
+        sources = [
+            TaxonomySource(
+                path=f"test-fixture-{version}", version_date=version_date, version=version
+            )
+            for version, version_date in enumerate(VERSION_DATES)
+        ]
+        session.add_all(sources)
         session.flush()
-        for event in EVENTS:
-            session.add(Taxonomy(taxonomy_source_id=source.id, **event))
+        for event_id, event in enumerate(EVENTS, start=1):
+            event = dict(event)
+            version = VERSION_DATES.index(event.pop("version_date"))
+            session.add(
+                Taxonomy(
+                    id=event_id, taxonomy_source_id=sources[version].id, version=version, **event
+                )
+            )
         session.commit()
 
     with engine.connect() as conn:
@@ -287,9 +348,20 @@ def db():
                 "INSERT INTO name_fts(name) SELECT DISTINCT name FROM taxonomy WHERE name IS NOT NULL"
             )
         )
+        if request.param == "legacy":
+            for table in DERIVED_TABLES:
+                conn.execute(text(f"DROP TABLE {table}"))
+        else:
+            rebuild_state_table(conn)
+            conn.execute(text(CREATE_FTS_TABLE))
+            conn.execute(text(CREATE_TRIGRAM_TABLE))
+            rebuild_name_search(conn)
         conn.commit()
 
-    tm = TimeMachine.__new__(TimeMachine)
-    tm.conn = raw_conn
-    tm.cursor = raw_conn.cursor()
-    return tm
+    if request.param != "legacy":
+        rebuild_lineage_versions(raw_conn)
+        rebuild_tree_versions(raw_conn)
+
+    if request.param == "memory":
+        return MemoryTimeMachine.from_connection(raw_conn)
+    return TimeMachine.from_connection(raw_conn)
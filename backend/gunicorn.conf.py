@@ -0,0 +1,38 @@
+# Production server configuration: gunicorn -c gunicorn.conf.py app:app
+#
+# The app is imported and warmed up once in the master process. Workers are
+# forked afterwards and share the loaded indexes copy-on-write; each worker
+# (and each of its threads) opens its own SQLite connection.
+
+import gc
+import os
+
+bind = os.environ.get("TTM_BIND", "0.0.0.0:9606")
+
+# worker processes run in parallel; threads within a worker share its result
+# cache
+workers = int(os.environ.get("TTM_WORKERS", "2"))
+threads = int(os.environ.get("TTM_THREADS", "4"))
+worker_class = "gthread"
+
+timeout = int(os.environ.get("TTM_TIMEOUT", "120"))
+
+preload_app = True
+
+accesslog = "-"
+
+
+def when_ready(server):
+    import app
+
+    app.warm_up()
+
+    # move everything loaded so far out of the garbage collector's reach so
+    # that collections in the workers don't touch (and copy) those pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import app
+
+    app.reset_connections()
@@ -1,2 +1,5 @@
 from .time_machine import TimeMachine
 from .event import Event, EventName
+from .event_store import EventStore, MemoryTimeMachine
+
+__all__ = ["Event", "EventName", "EventStore", "MemoryTimeMachine", "TimeMachine"]
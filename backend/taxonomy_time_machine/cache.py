@@ -0,0 +1,120 @@
+import functools
+import inspect
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from typing import Any
+
+MISSING = object()
+
+
+def _weight(value: Any) -> int:
+    """Approximate size of a cached result (the number of events in it)"""
+    return len(value) if isinstance(value, (list, tuple, dict, set)) else 1
+
+
+class ResultCache:
+    """Thread-safe LRU cache for query results, shared by every TimeMachine in
+    the process.
+
+    The cache is bounded both by number of entries and by total weight (the
+    number of events held by all cached results). Least-recently used entries
+    are evicted first.
+    """
+
+    def __init__(self, maxsize: int = 4096, max_weight: int = 1_000_000):
+        self.maxsize = maxsize
+        self.max_weight = max_weight
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.weight = 0
+        self._entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any:
+        """Return the cached value for key, or MISSING"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        weight = _weight(value)
+
+        # don't let a single huge result flush the whole cache
+        if weight > self.max_weight:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.weight -= self._entries.pop(key)[1]
+
+            self._entries[key] = (value, weight)
+            self.weight += weight
+
+            while len(self._entries) > self.maxsize or self.weight > self.max_weight:
+                _, (_, evicted_weight) = self._entries.popitem(last=False)
+                self.weight -= evicted_weight
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.weight = 0
+
+    def stats(self) -> dict[str, int | float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "weight": self.weight,
+                "maxsize": self.maxsize,
+                "max_weight": self.max_weight,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+shared_cache = ResultCache(
+    maxsize=int(os.environ.get("TTM_CACHE_SIZE", "4096")),
+    max_weight=int(os.environ.get("TTM_CACHE_MAX_EVENTS", "1000000")),
+)
+
+
+def cached(method: Callable) -> Callable:
+    """Cache a TimeMachine method's results in the instance's ResultCache.
+
+    Keys are namespaced by the instance's `cache_namespace()` (the database and
+    its latest taxonomy source) so that results cached before a new taxdump was
+    loaded are never returned.
+    """
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.cache is None:
+            return method(self, *args, **kwargs)
+
+        # normalize positional/keyword arguments and defaults into one key
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        key = (self.cache_namespace(), method.__name__, *list(bound.arguments.values())[1:])
+
+        value = self.cache.get(key)
+        if value is MISSING:
+            value = method(self, *args, **kwargs)
+            self.cache.set(key, value)
+        return value
+
+    return wrapper
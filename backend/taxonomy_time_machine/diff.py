@@ -0,0 +1,56 @@
+import os
+from dataclasses import dataclass, field
+
+from .cache import ResultCache
+from .event import Event, EventName
+
+# attributes of a taxon whose changes are reported
+TRACKED_FIELDS = ("name", "rank", "parent_id")
+
+# the sorted tax IDs with events between two versions, which diff pages are
+# sliced from. They can be millions of tax IDs, so only a few are kept.
+diff_tax_ids_cache = ResultCache(maxsize=int(os.environ.get("TTM_DIFF_CACHE_SIZE", "4")))
+
+
+@dataclass
+class Change:
+    """Net change of a tax ID between two versions: its state before (the last
+    event up to the first version) and after (the last event up to the second
+    version)"""
+
+    event_name: EventName
+    tax_id: str
+    before: Event | None = None
+    after: Event | None = None
+    changed_fields: list[str] = field(default_factory=list)
+
+    @property
+    def rank(self) -> str | None:
+        if self.after is not None and self.after.rank is not None:
+            return self.after.rank
+        return self.before.rank if self.before is not None else None
+
+
+def _exists(event: Event | None) -> bool:
+    return event is not None and event.event_name not in (EventName.Delete, EventName.Merge)
+
+
+def net_change(tax_id: str, before: Event | None, after: Event | None) -> Change | None:
+    """Collapse everything that happened to a tax ID between two versions into
+    a single change, or None if its state is the same in both"""
+
+    if not _exists(before):
+        if not _exists(after):
+            return None
+        return Change(EventName.Create, tax_id, before=None, after=after)
+
+    if not _exists(after):
+        # after can't be None: tax IDs don't lose events
+        return Change(after.event_name, tax_id, before=before, after=after)
+
+    changed_fields = [f for f in TRACKED_FIELDS if getattr(before, f) != getattr(after, f)]
+    if not changed_fields:
+        return None
+    return Change(
+        EventName.Update, tax_id, before=before, after=after, changed_fields=changed_fields
+    )
@@ -1,6 +1,9 @@
+import sqlite3
 from dataclasses import dataclass
 from datetime import datetime
 from enum import Enum
+from functools import lru_cache
+from sys import intern
 
 
 class EventName(Enum):
@@ -10,8 +13,27 @@ class EventName(Enum):
     Update = "alter"  # TODO: change me to Update
 
 
+# event names by their value, faster than EventName(value)
+EVENT_NAMES = {e.value: e for e in EventName}
+
+
+@lru_cache(maxsize=4096)
+def parse_version_date(value: str) -> datetime:
+    # there are only a few hundred versions, so most rows share their date
+    return datetime.fromisoformat(value)
+
+
+def intern_rank(rank: str | None) -> str | None:
+    return None if rank is None else intern(rank)
+
+
+def to_tax_id(value: int | str | None) -> str | None:
+    # tax IDs are stored as integers but are strings everywhere else
+    return None if value is None else str(value)
+
+
 # TODO: encode what changed using a bitarray
-@dataclass
+@dataclass(slots=True)
 class Event:
     event_name: EventName
     tax_id: str
@@ -27,17 +49,33 @@ class Event:
         version_date = data["version_date"]
 
         if type(version_date) is str:
-            version_date = datetime.fromisoformat(data["version_date"])
+            version_date = parse_version_date(version_date)
 
         return cls(
-            event_name=EventName(data["event_name"]),  # Convert to enum
-            tax_id=data["tax_id"],
+            event_name=EVENT_NAMES[data["event_name"]],
+            tax_id=str(data["tax_id"]),
             version_date=version_date,
             name=data.get("name"),
-            rank=data.get("rank"),
-            parent_id=data.get("parent_id"),
+            rank=intern_rank(data.get("rank")),
+            parent_id=to_tax_id(data.get("parent_id")),
             taxonomy_source_id=data.get("taxonomy_source_id"),
-            merged_into_id=data.get("merged_into_id"),
+            merged_into_id=to_tax_id(data.get("merged_into_id")),
+        )
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row, version_dates: list[datetime]):
+        """Build an event from a taxonomy row (which must have all of its
+        columns) without copying it to a dict first. version_dates maps
+        version ordinals to dates (see models.read_version_dates)."""
+        return cls(
+            event_name=EVENT_NAMES[row["event_name"]],
+            tax_id=str(row["tax_id"]),
+            version_date=version_dates[row["version"]],
+            taxonomy_source_id=row["taxonomy_source_id"],
+            name=row["name"],
+            rank=intern_rank(row["rank"]),
+            parent_id=to_tax_id(row["parent_id"]),
+            merged_into_id=to_tax_id(row["merged_into_id"]),
         )
 
     def to_dict(self) -> dict:
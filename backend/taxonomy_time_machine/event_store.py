@@ -0,0 +1,297 @@
+import logging
+import sqlite3
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections.abc import Hashable
+from datetime import datetime
+
+from .event import Event, EventName
+from .models import read_version_dates
+from .time_machine import TimeMachine
+
+# sentinel for NULL tax IDs (parent_id, merged_into_id) in the integer columns
+NO_TAX_ID = -1
+
+# NOTE: NCBI tax IDs are numeric, so they're stored as integers and converted
+# back into strings when building Event objects
+
+
+class EventStore:
+    """Read-only, columnar copy of the taxonomy table.
+
+    Rows are sorted by (tax_id, version) and stored as parallel arrays. Names
+    and ranks are dictionary-encoded and versions are the ordinals stored in
+    the taxonomy table. Rows for a tax ID
+    (or for a parent ID) are located through CSR-style offset arrays indexed
+    directly by the integer tax ID.
+    """
+
+    def __init__(
+        self,
+        tax_ids: array,
+        parent_ids: array,
+        versions: array,
+        event_codes: array,
+        name_codes: array,
+        rank_codes: array,
+        source_ids: array,
+        merged_into_ids: array,
+        tax_id_offsets: array,
+        parent_rows: array,
+        parent_id_offsets: array,
+        version_dates: list[datetime],
+        names: list[str | None],
+        ranks: list[str | None],
+    ):
+        self.tax_ids = tax_ids
+        self.parent_ids = parent_ids
+        self.versions = versions
+        self.event_codes = event_codes
+        self.name_codes = name_codes
+        self.rank_codes = rank_codes
+        self.source_ids = source_ids
+        self.merged_into_ids = merged_into_ids
+        self.tax_id_offsets = tax_id_offsets
+        self.parent_rows = parent_rows
+        self.parent_id_offsets = parent_id_offsets
+        self.version_dates = version_dates
+        self.names = names
+        self.ranks = ranks
+        self.event_names = list(EventName)
+
+    def __len__(self) -> int:
+        return len(self.tax_ids)
+
+    @classmethod
+    def from_connection(cls, conn: sqlite3.Connection) -> "EventStore":
+        """Load the taxonomy table from an open SQLite connection"""
+
+        version_dates = read_version_dates(conn)
+
+        (max_tax_id,) = conn.execute(
+            """SELECT MAX(
+                (SELECT COALESCE(MAX(tax_id), 0) FROM taxonomy),
+                (SELECT COALESCE(MAX(parent_id), 0) FROM taxonomy)
+            )"""
+        ).fetchone()
+        n_slots = (max_tax_id or 0) + 2
+
+        event_name_to_code = {e.value: n for n, e in enumerate(EventName)}
+        names: list[str | None] = [None]
+        name_to_code: dict[str | None, int] = {None: 0}
+        ranks: list[str | None] = [None]
+        rank_to_code: dict[str | None, int] = {None: 0}
+
+        tax_ids = array("i")
+        parent_ids = array("i")
+        versions = array("H")
+        event_codes = array("B")
+        name_codes = array("i")
+        rank_codes = array("H")
+        source_ids = array("i")
+        merged_into_ids = array("i")
+        tax_id_counts = array("i", [0]) * n_slots
+
+        rows = conn.execute(
+            """SELECT tax_id, parent_id, version, event_name, name, rank,
+                taxonomy_source_id, merged_into_id
+            FROM taxonomy
+            ORDER BY tax_id, version, id"""
+        )
+
+        for r in rows:
+            tax_id = int(r[0])
+            name, rank = r[4], r[5]
+
+            if (name_code := name_to_code.get(name)) is None:
+                name_code = name_to_code[name] = len(names)
+                names.append(name)
+
+            if (rank_code := rank_to_code.get(rank)) is None:
+                rank_code = rank_to_code[rank] = len(ranks)
+                ranks.append(rank)
+
+            tax_ids.append(tax_id)
+            parent_ids.append(NO_TAX_ID if r[1] is None else int(r[1]))
+            versions.append(r[2])
+            event_codes.append(event_name_to_code[r[3]])
+            name_codes.append(name_code)
+            rank_codes.append(rank_code)
+            source_ids.append(NO_TAX_ID if r[6] is None else r[6])
+            merged_into_ids.append(NO_TAX_ID if r[7] is None else int(r[7]))
+            tax_id_counts[tax_id + 1] += 1
+
+        # row positions (in the order above) grouped by parent ID, ordered
+        # within each group the same way get_events orders them
+        parent_rows = array("i")
+        parent_id_counts = array("i", [0]) * n_slots
+
+        for parent_id, row in conn.execute(
+            """SELECT parent_id, row FROM (
+                SELECT parent_id, version, id, ROW_NUMBER() OVER (
+                    ORDER BY tax_id, version, id
+                ) - 1 AS row
+                FROM taxonomy
+            )
+            WHERE parent_id IS NOT NULL
+            ORDER BY parent_id, version, id"""
+        ):
+            parent_rows.append(row)
+            parent_id_counts[int(parent_id) + 1] += 1
+
+        return cls(
+            tax_ids=tax_ids,
+            parent_ids=parent_ids,
+            versions=versions,
+            event_codes=event_codes,
+            name_codes=name_codes,
+            rank_codes=rank_codes,
+            source_ids=source_ids,
+            merged_into_ids=merged_into_ids,
+            tax_id_offsets=_cumulative_sum(tax_id_counts),
+            parent_rows=parent_rows,
+            parent_id_offsets=_cumulative_sum(parent_id_counts),
+            version_dates=version_dates,
+            names=names,
+            ranks=ranks,
+        )
+
+    def _max_version(self, as_of: datetime | None) -> int:
+        """Return the number of version ordinals <= as_of"""
+        if as_of is None:
+            return len(self.version_dates)
+        return bisect_right(self.version_dates, as_of)
+
+    def _offsets(self, offsets: array, tax_id: str) -> tuple[int, int]:
+        try:
+            key = int(tax_id)
+        except ValueError:
+            return 0, 0
+
+        if not (0 <= key < len(offsets) - 1):
+            return 0, 0
+
+        return offsets[key], offsets[key + 1]
+
+    def _event(self, row: int) -> Event:
+        parent_id = self.parent_ids[row]
+        merged_into_id = self.merged_into_ids[row]
+        source_id = self.source_ids[row]
+
+        return Event(
+            event_name=self.event_names[self.event_codes[row]],
+            tax_id=str(self.tax_ids[row]),
+            version_date=self.version_dates[self.versions[row]],
+            taxonomy_source_id=None if source_id == NO_TAX_ID else source_id,
+            name=self.names[self.name_codes[row]],
+            rank=self.ranks[self.rank_codes[row]],
+            parent_id=None if parent_id == NO_TAX_ID else str(parent_id),
+            merged_into_id=None if merged_into_id == NO_TAX_ID else str(merged_into_id),
+        )
+
+    def events_by_tax_id(self, tax_id: str, as_of: datetime | None = None) -> list[Event]:
+        """Get all events for a tax ID sorted by version_date"""
+        start, end = self._offsets(self.tax_id_offsets, tax_id)
+        max_version = self._max_version(as_of)
+        versions = self.versions
+        return [self._event(row) for row in range(start, end) if versions[row] < max_version]
+
+    def events_by_parent_id(self, parent_id: str, as_of: datetime | None = None) -> list[Event]:
+        """Get all events that have the given parent ID sorted by version_date"""
+        start, end = self._offsets(self.parent_id_offsets, parent_id)
+        max_version = self._max_version(as_of)
+        versions = self.versions
+        return [
+            self._event(row) for row in self.parent_rows[start:end] if versions[row] < max_version
+        ]
+
+    def most_recent_events(self) -> dict[str, Event]:
+        """Get the last event for every tax ID"""
+        offsets = self.tax_id_offsets
+        return {
+            str(tax_id): self._event(offsets[tax_id + 1] - 1)
+            for tax_id in range(len(offsets) - 1)
+            if offsets[tax_id + 1] > offsets[tax_id]
+        }
+
+
+def _cumulative_sum(counts: array) -> array:
+    """Turn counts (shifted right by one) into CSR offsets in place"""
+    total = 0
+    for n, count in enumerate(counts):
+        total += count
+        counts[n] = total
+    return counts
+
+
+# one store per database, replaced when the data version changes
+_stores: dict[Hashable, tuple[Hashable, EventStore]] = {}
+_stores_lock = threading.Lock()
+
+
+def load_event_store(
+    conn: sqlite3.Connection, database: Hashable, data_version: Hashable
+) -> EventStore:
+    """Load the EventStore of a database once per data version and share it
+    between threads"""
+    with _stores_lock:
+        entry = _stores.get(database)
+
+        if entry is None or entry[0] != data_version:
+            _profile_start = time.perf_counter()
+            store = EventStore.from_connection(conn)
+            elapsed = time.perf_counter() - _profile_start
+            logging.info(f"loaded {len(store):,} events into memory in {elapsed:.2f} s")
+            entry = _stores[database] = (data_version, store)
+
+        return entry[1]
+
+
+class MemoryTimeMachine(TimeMachine):
+    """TimeMachine that answers event queries from an in-memory EventStore
+    instead of issuing one SQLite query per call. Name search still uses the
+    database's FTS index."""
+
+    def _connect(self, conn: sqlite3.Connection):
+        super()._connect(conn)
+        # the event store is faster than the (on-disk) state table
+        self.has_state_table = False
+        # load the events now rather than on the first query
+        self._get_store()
+
+    def _get_store(self) -> EventStore:
+        """Get the in-memory copy of the taxonomy table, reloaded after new
+        taxdumps are loaded"""
+        database, data_version = self.cache_namespace()
+        return load_event_store(self.conn, database=database, data_version=data_version)
+
+    def get_events(
+        self,
+        tax_id: str,
+        as_of: datetime | None = None,
+        query_key="tax_id",
+    ) -> list[Event]:
+        """Get all events for a given tax_id or parent_id depending on
+        query_key (default='tax_id')"""
+        if query_key == "tax_id":
+            return self._get_store().events_by_tax_id(tax_id, as_of=as_of)
+        elif query_key == "parent_id":
+            return self._get_store().events_by_parent_id(tax_id, as_of=as_of)
+        else:
+            raise Exception(f"Unable to use handle {query_key=}")
+
+    def _get_child_histories(
+        self, tax_id: str, as_of: datetime | None = None
+    ) -> dict[str, list[Event]]:
+        store = self._get_store()
+        histories: dict[str, list[Event]] = {}
+        for event in store.events_by_parent_id(tax_id, as_of=as_of):
+            if event.tax_id not in histories:
+                histories[event.tax_id] = store.events_by_tax_id(event.tax_id, as_of=as_of)
+        return histories
+
+    def get_most_recent_events(self) -> dict[str, Event]:
+        """Get the most recent event (version) for each Tax ID in the database"""
+        return self._get_store().most_recent_events()
@@ -0,0 +1,189 @@
+import sqlite3
+from array import array
+from collections.abc import Iterator
+
+from .event import EventName
+from .event_store import NO_TAX_ID, EventStore
+
+# lineage hash of a tax ID that doesn't have a lineage (yet)
+EMPTY_LINEAGE = 0
+
+_DELETE_CODES = {list(EventName).index(EventName.Delete), list(EventName).index(EventName.Merge)}
+
+
+def _lineage_entry(store: EventStore, tax_id: int, version: int) -> tuple[int, ...] | None:
+    """Return the (rank, tax_id, parent_id, name) codes of the event that
+    get_lineage would use for tax_id as of a version ordinal"""
+    start, end = store.tax_id_offsets[tax_id], store.tax_id_offsets[tax_id + 1]
+    rows = [row for row in range(start, end) if store.versions[row] <= version]
+
+    # find most recent event where the parent_id changed
+    parent_row = next((r for r in reversed(rows) if store.parent_ids[r] != NO_TAX_ID), None)
+
+    if parent_row is None:
+        return None
+
+    named_row = parent_row
+
+    # deleted/merged taxa keep their last known name and rank
+    if store.event_codes[parent_row] in _DELETE_CODES:
+        named_row = next(
+            (r for r in reversed(rows) if store.names[store.name_codes[r]]), parent_row
+        )
+
+    return (
+        store.rank_codes[named_row],
+        tax_id,
+        store.parent_ids[parent_row],
+        store.name_codes[named_row],
+    )
+
+
+def iter_lineage_versions(store: EventStore) -> Iterator[tuple[int, int]]:
+    """Replay all events one version at a time and yield (tax_id, version
+    ordinal) for every version at which a tax ID's lineage became one that it
+    hadn't had before. This matches the versions found by
+    TimeMachine.get_versions, except for the cut-off at deletion dates (see
+    update_lineage_versions).
+
+    Lineages are compared by hash: the lineage hash of a tax ID combines the
+    hash of its own lineage entry with the lineage hash of its parent, so only
+    tax IDs with events in a version and their descendants need to be updated.
+    """
+    n_slots = len(store.tax_id_offsets) - 1
+
+    parent_ids = array("i", [NO_TAX_ID]) * n_slots
+    entry_hashes = array("q", [EMPTY_LINEAGE]) * n_slots
+    lineage_hashes = array("q", [EMPTY_LINEAGE]) * n_slots
+    first_seen_hashes = array("q", [EMPTY_LINEAGE]) * n_slots
+    children: dict[int, set[int]] = {}
+    # lineage hashes seen for tax IDs whose lineage changed more than once
+    seen_hashes: dict[int, set[int]] = {}
+
+    rows_by_version: list[list[int]] = [[] for _ in store.version_dates]
+    for row, version in enumerate(store.versions):
+        rows_by_version[version].append(row)
+
+    for version, rows in enumerate(rows_by_version):
+        changed = {store.tax_ids[row] for row in rows}
+
+        for tax_id in changed:
+            entry = _lineage_entry(store, tax_id, version)
+            parent_id = NO_TAX_ID if entry is None else entry[2]
+            entry_hashes[tax_id] = EMPTY_LINEAGE if entry is None else hash(entry)
+
+            if parent_ids[tax_id] != parent_id:
+                if parent_ids[tax_id] != NO_TAX_ID:
+                    children[parent_ids[tax_id]].discard(tax_id)
+                if parent_id != NO_TAX_ID:
+                    children.setdefault(parent_id, set()).add(tax_id)
+                parent_ids[tax_id] = parent_id
+
+        # every descendant of a changed tax ID might have a new lineage
+        affected = set(changed)
+        stack = list(changed)
+        while stack:
+            for child in children.get(stack.pop(), ()):
+                if child not in affected:
+                    affected.add(child)
+                    stack.append(child)
+
+        # update lineage hashes, parents first
+        updated: set[int] = set()
+        for tax_id in affected:
+            path = []
+            node = tax_id
+            while node != NO_TAX_ID and node in affected and node not in updated:
+                updated.add(node)
+                path.append(node)
+                node = parent_ids[node]
+
+            for node in reversed(path):
+                parent_id = parent_ids[node]
+                if parent_id == NO_TAX_ID:
+                    lineage_hashes[node] = EMPTY_LINEAGE
+                else:
+                    lineage_hashes[node] = hash((entry_hashes[node], lineage_hashes[parent_id]))
+
+        for tax_id in affected:
+            lineage_hash = lineage_hashes[tax_id]
+
+            # taxa without a lineage don't have versions
+            if parent_ids[tax_id] == NO_TAX_ID:
+                continue
+
+            if first_seen_hashes[tax_id] == EMPTY_LINEAGE:
+                first_seen_hashes[tax_id] = lineage_hash
+            elif lineage_hash == first_seen_hashes[tax_id]:
+                continue
+            elif lineage_hash in seen_hashes.setdefault(tax_id, set()):
+                continue
+            else:
+                seen_hashes[tax_id].add(lineage_hash)
+
+            yield tax_id, version
+
+
+def update_lineage_versions(conn: sqlite3.Connection, store: EventStore | None = None) -> int:
+    """Add the lineage versions of every version that isn't in the
+    lineage_version table yet (i.e. the versions of newly loaded taxdumps).
+    Returns the number of rows written."""
+
+    if store is None:
+        store = EventStore.from_connection(conn)
+
+    (last_version,) = conn.execute("SELECT MAX(version) FROM lineage_version").fetchone()
+    if last_version is None:
+        last_version = -1
+
+    offsets = store.tax_id_offsets
+
+    # versions of deleted/merged taxa stop at the deletion date (which is
+    # always a version). Taxa that were deleted and have been re-created since
+    # no longer stop there, so all of their versions are recomputed.
+    deletion_versions: dict[int, int] = {}
+    recreated_tax_ids: set[int] = set()
+    for tax_id in range(len(offsets) - 1):
+        start, end = offsets[tax_id], offsets[tax_id + 1]
+        if end == start:
+            continue
+
+        last_row = end - 1
+        if store.event_codes[last_row] in _DELETE_CODES:
+            deletion_versions[tax_id] = store.versions[last_row]
+
+        while last_row >= start and store.versions[last_row] > last_version:
+            last_row -= 1
+        if (
+            last_row >= start
+            and last_row < end - 1
+            and store.event_codes[last_row] in _DELETE_CODES
+        ):
+            recreated_tax_ids.add(tax_id)
+
+    def rows():
+        for tax_id, version in iter_lineage_versions(store):
+            if version > last_version or tax_id in recreated_tax_ids:
+                if version <= deletion_versions.get(tax_id, version):
+                    yield tax_id, version
+
+        for tax_id, version in deletion_versions.items():
+            if version > last_version:
+                yield tax_id, version
+
+    conn.executemany(
+        "DELETE FROM lineage_version WHERE tax_id = ?", ((t,) for t in recreated_tax_ids)
+    )
+    n_rows = conn.executemany(
+        "INSERT OR IGNORE INTO lineage_version (tax_id, version) VALUES (?, ?)", rows()
+    ).rowcount
+    conn.commit()
+
+    return n_rows
+
+
+def rebuild_lineage_versions(conn: sqlite3.Connection, store: EventStore | None = None) -> int:
+    """Recompute the lineage_version table from the taxonomy table. Returns the
+    number of rows written."""
+    conn.execute("DELETE FROM lineage_version")
+    return update_lineage_versions(conn, store=store)
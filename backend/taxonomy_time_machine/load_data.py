@@ -1,23 +1,34 @@
 #!/usr/bin/env python3
 
 import argparse
-from collections import Counter
+import sqlite3
+import time
+from collections import Counter, deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import closing
 from datetime import datetime
+from itertools import islice
 from pathlib import Path
+from sys import intern
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import Connection, create_engine, text
 from sqlalchemy.orm import sessionmaker
 from taxonomy import Taxonomy
 from tqdm import tqdm
 
-from . import TimeMachine
 from .event import Event, EventName
+from .event_store import EventStore
+from .lineage_versions import update_lineage_versions
 from .models import (
     Taxonomy as TaxonomyModel,
 )
 from .models import (
     TaxonomySource,
 )
+from .name_search import update_name_search
+from .state import update_state_table
+from .tree_versions import update_tree_versions
 
 
 def parse_args():
@@ -29,6 +40,19 @@ def parse_args():
         help="path to output sqlite database",
     )
     parser.add_argument("--dumps-dir", default="dumps")
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="drop the taxonomy table's secondary indexes while inserting events and "
+        "rebuild them at the end (faster when importing many taxdumps)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes parsing taxdumps ahead of the one being imported "
+        "(each parsed taxdump is held in memory until it's imported)",
+    )
     return parser.parse_args()
 
 
@@ -36,10 +60,44 @@ def dump_path_to_datetime(dump_path: Path) -> datetime:
     return datetime.strptime(dump_path.name.split("_")[1], "%Y-%m-%d")
 
 
-def load_current_tax_id_to_node(database_path: str) -> dict[str, Event]:
-    """Load current tax ID to node state"""
+# tax ID -> (parent ID, rank, name)
+Nodes = dict[str, tuple[str | None, str, str]]
+
+
+def load_current_tax_id_to_node(conn: Connection) -> Nodes:
+    """Load the current state of every tax ID that exists (i.e. whose last
+    event isn't a deletion or merge) from the taxonomy_state rows that are
+    still valid.
+
+    Tax IDs and ranks are interned, so a parent ID shares its string with
+    the parent's own key and ranks are stored once.
+    """
+
+    # bring the state table up to date first (taxdumps imported by a run that
+    # stopped before updating it)
+    last_event_id = conn.execute(
+        text("SELECT COALESCE(MAX(event_id), 0) FROM taxonomy_state")
+    ).scalar()
+    update_state_table(conn, after_event_id=last_event_id)
+    conn.commit()
+
+    rows = conn.exec_driver_sql(
+        """SELECT taxonomy.tax_id, taxonomy.parent_id, taxonomy.rank, taxonomy.name
+        FROM taxonomy_state
+        JOIN taxonomy ON taxonomy.id = taxonomy_state.event_id
+        WHERE taxonomy_state.valid_to IS NULL
+        AND taxonomy_state.event_name NOT IN (?, ?)""",
+        (EventName.Delete.value, EventName.Merge.value),
+    )
 
-    return TimeMachine(database_path=database_path).get_most_recent_events()
+    return {
+        intern(str(tax_id)): (
+            None if parent_id is None else intern(str(parent_id)),
+            None if rank is None else intern(rank),
+            name,
+        )
+        for tax_id, parent_id, rank, name in rows
+    }
 
 
 def load_merged_dump(dump_path: Path) -> dict[str, str]:
@@ -66,12 +124,173 @@ def load_merged_dump(dump_path: Path) -> dict[str, str]:
 def setup_sqlite_performance(engine):
     """Optimize SQLite for bulk inserts"""
     with engine.connect() as conn:
-        conn.execute(text("PRAGMA synchronous = OFF"))
-        conn.execute(text("PRAGMA journal_mode = MEMORY"))
+        # each taxdump is committed in one transaction, which must survive the
+        # loader crashing: keep the rollback journal on disk (an in-memory
+        # journal can leave the database corrupt)
+        conn.execute(text("PRAGMA synchronous = NORMAL"))
         conn.execute(text("PRAGMA temp_store = MEMORY"))
         conn.commit()
 
 
+_INSERT_EVENTS = """INSERT INTO taxonomy
+    (id, taxonomy_source_id, event_name, version, tax_id, parent_id, rank, name,
+    merged_into_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+
+def insert_events(conn: Connection, events: list[Event], batch_size: int = 10_000) -> None:
+    """Insert events into the taxonomy table with executemany, bypassing the ORM.
+    Events get consecutive IDs after the largest existing one and the version
+    of the taxonomy source with their date."""
+    (first_id,) = conn.execute(text("SELECT COALESCE(MAX(id), 0) + 1 FROM taxonomy")).one()
+    versions = {
+        datetime.fromisoformat(version_date): version
+        for version, version_date in conn.execute(
+            text("SELECT DISTINCT version, version_date FROM taxonomy_source")
+        )
+    }
+
+    for i in range(0, len(events), batch_size):
+        conn.exec_driver_sql(
+            _INSERT_EVENTS,
+            [
+                (
+                    first_id + j,
+                    event.taxonomy_source_id,
+                    event.event_name.value,
+                    versions[event.version_date],
+                    event.tax_id,
+                    event.parent_id,
+                    event.rank,
+                    event.name,
+                    event.merged_into_id,
+                )
+                for j, event in enumerate(events[i : i + batch_size], start=i)
+            ],
+        )
+
+
+def existing_indexes(conn: Connection) -> set[str]:
+    # (SQLAlchemy's checkfirst doesn't see expression indexes such as idx_name)
+    return set(conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'")).scalars())
+
+
+def parse_taxdump(taxdump_path: Path) -> tuple[Nodes, dict[str, str]]:
+    """Parse a taxdump's nodes (in the order Taxonomy.from_ncbi yields them) and
+    merges. Both are plain dicts so that they can be sent back from worker
+    processes."""
+    tax = Taxonomy.from_ncbi(str(taxdump_path))
+
+    nodes: Nodes = {}
+    for tax_id in tax:
+        node = tax[tax_id]
+        nodes[tax_id] = (node.parent, intern(node.rank), node.name)
+
+    return nodes, load_merged_dump(taxdump_path)
+
+
+def iter_parsed_taxdumps(
+    taxdump_paths: list[Path], workers: int = 1
+) -> Iterator[tuple[Nodes, dict[str, str]]]:
+    """Parse taxdumps in order. With more than one worker, the next `workers`
+    taxdumps are parsed ahead in a process pool while the caller processes the
+    current one."""
+    if workers <= 1:
+        for taxdump_path in taxdump_paths:
+            yield parse_taxdump(taxdump_path)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending: deque[Future] = deque()
+        remaining = iter(taxdump_paths)
+
+        for taxdump_path in islice(remaining, workers):
+            pending.append(pool.submit(parse_taxdump, taxdump_path))
+
+        while pending:
+            parsed = pending.popleft().result()
+
+            # refill the window before handing over the parsed taxdump
+            for taxdump_path in islice(remaining, 1):
+                pending.append(pool.submit(parse_taxdump, taxdump_path))
+
+            yield parsed
+
+
+def diff_taxdump(
+    nodes: Nodes,
+    merged: dict[str, str],
+    tax_id_to_node: Nodes,
+    taxdump_date: datetime,
+    taxonomy_source_id: int,
+) -> list[Event]:
+    """Compare a taxdump to the current state of every tax ID and return the
+    events needed to get from one to the other. tax_id_to_node is updated to
+    the taxdump's state."""
+
+    # we infer deleted nodes by comparing the tax IDs in the current dump to those
+    # that currently exist
+    deleted_tax_ids = [tax_id for tax_id in tax_id_to_node if tax_id not in nodes]
+    events: list[Event] = []
+
+    for tax_id, node in nodes.items():
+        from_node = tax_id_to_node.get(tax_id)
+
+        # *nothing* changed
+        if node == from_node:
+            continue
+
+        parent_id, rank, name = node
+        events.append(
+            Event(
+                # node isn't in tax_id_to_node -- it must be new
+                event_name=EventName.Create if from_node is None else EventName.Update,
+                tax_id=tax_id,
+                rank=rank,
+                name=name,
+                parent_id=parent_id,
+                version_date=taxdump_date,
+                taxonomy_source_id=taxonomy_source_id,
+            )
+        )
+        tax_id_to_node[tax_id] = node
+
+    # append deletions
+    for tax_id in deleted_tax_ids:
+        # Store the parent_id (from the last state of the tax ID) so that we can find
+        # the deletion events by parent_id (useful for excluding deleted children from
+        # get_children)
+        parent_id = tax_id_to_node[tax_id][0]
+
+        # this taxid was merged into another taxid
+        if tax_id in merged:
+            events.append(
+                Event(
+                    event_name=EventName.Merge,
+                    tax_id=tax_id,
+                    parent_id=parent_id,
+                    version_date=taxdump_date,
+                    taxonomy_source_id=taxonomy_source_id,
+                    merged_into_id=merged[tax_id],
+                )
+            )
+        else:
+            events.append(
+                Event(
+                    event_name=EventName.Delete,
+                    tax_id=tax_id,
+                    parent_id=parent_id,
+                    version_date=taxdump_date,
+                    taxonomy_source_id=taxonomy_source_id,
+                )
+            )
+
+        # remove from tax_id_to_node in case this tax ID gets re-created
+        del tax_id_to_node[tax_id]
+
+    return events
+
+
 def main() -> None:
     args = parse_args()
 
@@ -81,9 +300,8 @@ def main() -> None:
 
     # stores the *last* state of a Tax ID
     # used to determine if a tax ID has changed
-    tax_id_to_node: dict[str, Event]
-
-    tax_id_to_node = load_current_tax_id_to_node(args.db_path)
+    with engine.connect() as conn:
+        tax_id_to_node = load_current_tax_id_to_node(conn)
 
     # Optimize SQLite for bulk inserts
     setup_sqlite_performance(engine)
@@ -108,157 +326,119 @@ def main() -> None:
             else:
                 print(f"Skipping {taxdump_path} [already imported]")
 
+        # versions are numbered in date order, so taxdumps can only be appended
+        last_version_date = session.execute(
+            text("SELECT MAX(version_date) FROM taxonomy_source")
+        ).scalar()
+
+    if paths_to_import and last_version_date is not None:
+        first_date = dump_path_to_datetime(paths_to_import[0])
+        if first_date <= datetime.fromisoformat(last_version_date):
+            raise SystemExit(
+                f"{paths_to_import[0]} is not newer than the last imported taxdump "
+                f"({last_version_date}); rebuild the database to import it"
+            )
+
     n_events = 0
 
-    print(f"Found {len(tax_id_to_node):,} existing taxonomy versions")
+    print(f"Found {len(tax_id_to_node):,} existing tax IDs")
     print(f"Importing from {len(paths_to_import):,} of {len(taxdump_paths):,} taxdumps")
 
-    data_to_insert: list[dict] = []
-    last_tax_ids: None | set[str] = None
-
+    total_event_counts: Counter[EventName] = Counter()
     total_seen_taxa = 0
-
-    last_tax = None
-
-    for n, taxdump_path in enumerate(tqdm(paths_to_import, colour="green")):
+    insert_seconds = 0.0
+
+    # secondary indexes of the taxonomy table (see models.py). They're only
+    # needed once all events are inserted, and maintaining them row by row is
+    # much slower than building them at the end.
+    indexes = sorted(TaxonomyModel.__table__.indexes, key=lambda index: index.name)
+
+    if args.bulk and paths_to_import:
+        print("--- dropping secondary indexes")
+        with engine.connect() as conn:
+            existing = existing_indexes(conn)
+            for index in indexes:
+                if index.name in existing:
+                    index.drop(conn)
+            conn.commit()
+
+    parsed_taxdumps = iter_parsed_taxdumps(paths_to_import, workers=args.workers)
+
+    for n, (taxdump_path, (nodes, merged)) in enumerate(
+        tqdm(
+            zip(paths_to_import, parsed_taxdumps, strict=True),
+            total=len(paths_to_import),
+            colour="green",
+        )
+    ):
         taxdump_date = dump_path_to_datetime(taxdump_path)
+        tqdm.write(f"--- loaded {taxdump_path}: {len(nodes):,} nodes, {len(merged):,} merges")
+
+        total_seen_taxa += len(nodes)
 
+        # the taxdump's events are committed along with its TaxonomySource in a
+        # single transaction, so an interrupted import resumes from the first
+        # taxdump that wasn't fully imported
         with Session() as session:
-            taxonomy_source = TaxonomySource(path=str(taxdump_path), version_date=taxdump_date)
+            version = session.execute(
+                text("SELECT COALESCE(MAX(version), -1) + 1 FROM taxonomy_source")
+            ).scalar()
+            taxonomy_source = TaxonomySource(
+                path=str(taxdump_path), version_date=taxdump_date, version=version
+            )
             session.add(taxonomy_source)
+            session.flush()
+
+            events = diff_taxdump(
+                nodes,
+                merged,
+                tax_id_to_node,
+                taxdump_date=taxdump_date,
+                taxonomy_source_id=taxonomy_source.id,
+            )
+
+            start = time.perf_counter()
+            insert_events(session.connection(), events)
             session.commit()
-            taxonomy_source_id = taxonomy_source.id
-
-        tax = Taxonomy.from_ncbi(str(taxdump_path))
-        merged = load_merged_dump(taxdump_path)
-        tqdm.write(f"--- loaded {taxdump_path}: {tax}")
-
-        total_seen_taxa += len(tax)
-
-        # we infer deleted nodes by comparing the tax IDs in the current dump to those
-        # found in the previous dump
-        seen_tax_ids: set[str] = set()
-        event_counts: Counter[EventName] = Counter()
-        n_new_events = 0
-        events: list[Event] = []
-
-        for tax_id in tax:
-            from_node = tax_id_to_node.get(tax_id)
-            to_node = tax[tax_id]
-            seen_tax_ids.add(tax_id)
-
-            event = None
-
-            # node isn't in tax_id_to_node -- it must be new
-            if from_node is None:
-                event = Event(
-                    event_name=EventName.Create,
-                    tax_id=to_node.id,
-                    rank=to_node.rank,
-                    name=to_node.name,
-                    parent_id=to_node.parent,
-                    version_date=taxdump_date,
-                    taxonomy_source_id=taxonomy_source_id,
-                )
-            # *something* changed
-            elif (from_node.parent_id, from_node.rank, from_node.name) != (
-                to_node.parent,
-                to_node.rank,
-                to_node.name,
-            ):
-                event = Event(
-                    event_name=EventName.Update,
-                    tax_id=to_node.id,
-                    rank=to_node.rank,
-                    name=to_node.name,
-                    parent_id=to_node.parent,
-                    version_date=taxdump_date,
-                    taxonomy_source_id=taxonomy_source_id,
-                )
+            elapsed = time.perf_counter() - start
+            insert_seconds += elapsed
 
-            if event is not None:
-                tax_id_to_node[tax_id] = event
-                events.append(event)
-                n_new_events += 1
-
-        # find all the deleted nodes
-
-        # append deletions
-        if last_tax_ids is not None:
-            for tax_id in last_tax_ids - seen_tax_ids:
-                # this taxid was merged into another taxid
-                if tax_id in merged:
-                    events.append(
-                        Event(
-                            event_name=EventName.Merge,
-                            tax_id=tax_id,
-                            parent_id=last_tax[tax_id].parent if last_tax else None,  # mypy: ignore
-                            version_date=taxdump_date,
-                            taxonomy_source_id=taxonomy_source_id,
-                            merged_into_id=merged[tax_id],
-                        )
-                    )
-                else:
-                    # Store the parent_id so that we can find the deletion events by parent_id
-                    # (useful for excluding deleted children from get_children)
-                    events.append(
-                        Event(
-                            event_name=EventName.Delete,
-                            tax_id=tax_id,
-                            # taxonomy library type annotation is wrong?
-                            parent_id=last_tax[tax_id].parent if last_tax else None,  # mypy: ignore
-                            version_date=taxdump_date,
-                            taxonomy_source_id=taxonomy_source_id,
-                        )
-                    )
-
-                # remove from tax_id_to_node in case this tax ID gets re-created
-                del tax_id_to_node[tax_id]
-        last_tax_ids = seen_tax_ids
-
-        for event in events:
-            event_counts[event.event_name] += 1
-            data_to_insert.append(event.to_dict())
-            n_events += 1
+        event_counts = Counter(event.event_name for event in events)
+        total_event_counts.update(event_counts)
+        n_events += len(events)
 
         tqdm.write(
-            f"{n}/{len(taxdump_paths)} total_events={n_events:,} n_new_events={n_new_events:,}"
+            f"{n}/{len(taxdump_paths)} total_events={n_events:,} n_new_events={len(events):,}"
+            f" ({len(events) / elapsed if elapsed else 0:,.0f} rows/s)"
         )
 
         for event_name, count in event_counts.items():
             tqdm.write(f"    {event_name.value:>10} -> {count:,}")
 
-        last_tax = tax
-
-    print(Counter([event["event_name"] for event in data_to_insert]))
+    print(Counter({event_name.value: count for event_name, count in total_event_counts.items()}))
 
     print(f"--- {total_seen_taxa=:,}")
-    print(f"--- {len(data_to_insert)=:,}")
+    print(f"--- {n_events=:,}")
 
     if total_seen_taxa > 0:
-        print(f"--- savings={1 - (len(data_to_insert) / total_seen_taxa):.2%}")
+        print(f"--- savings={1 - (n_events / total_seen_taxa):.2%}")
 
-    batch_size = 10_000
+    if insert_seconds > 0:
+        print(
+            f"--- inserted {n_events:,} events in {insert_seconds:.2f} s "
+            f"({n_events / insert_seconds:,.0f} rows/s)"
+        )
 
-    # Batch insert using SQLAlchemy bulk operations
-    with Session() as session:
-        for i in tqdm(range(0, len(data_to_insert), batch_size)):
-            batch = data_to_insert[i : i + batch_size]
-            taxonomy_objects = [
-                TaxonomyModel(
-                    event_name=item["event_name"],
-                    version_date=item["version_date"],
-                    tax_id=item["tax_id"],
-                    parent_id=item["parent_id"],
-                    rank=item["rank"],
-                    name=item["name"],
-                    taxonomy_source_id=item["taxonomy_source_id"],
-                    merged_into_id=item["merged_into_id"],
-                )
-                for item in batch
-            ]
-            session.bulk_save_objects(taxonomy_objects)
-            session.commit()
+    # also recreates indexes left dropped by an interrupted --bulk import
+    print("--- rebuilding secondary indexes")
+    start = time.perf_counter()
+    with engine.connect() as conn:
+        existing = existing_indexes(conn)
+        for index in indexes:
+            if index.name not in existing:
+                index.create(conn)
+        conn.commit()
+    print(f"--- rebuilt secondary indexes in {time.perf_counter() - start:.2f} s")
 
     print("--- wrapping up")
 
@@ -266,15 +446,32 @@ def main() -> None:
         count = session.query(TaxonomyModel).count()
         print(f"taxonomy version table now has {count:,} rows")
 
-    print("--- rebuilding FTS index")
+    print("--- updating validity intervals")
     with engine.connect() as conn:
-        conn.execute(text("DELETE FROM name_fts"))
-        conn.execute(
-            text(
-                "INSERT INTO name_fts(name) SELECT DISTINCT name FROM taxonomy WHERE name IS NOT NULL"
-            )
-        )
+        # events newer than the state table's, including those of taxdumps
+        # imported by an earlier run that stopped before this step
+        last_event_id = conn.execute(
+            text("SELECT COALESCE(MAX(event_id), 0) FROM taxonomy_state")
+        ).scalar()
+        update_state_table(conn, after_event_id=last_event_id)
+        conn.commit()
+
+    with closing(sqlite3.connect(args.db_path)) as raw_conn:
+        store = EventStore.from_connection(raw_conn)
+
+        print("--- computing lineage versions of new versions")
+        n_rows = update_lineage_versions(raw_conn, store=store)
+        print(f"added {n_rows:,} rows to the lineage_version table")
+
+        print("--- numbering trees of new versions")
+        n_trees = update_tree_versions(raw_conn, store=store)
+        print(f"added {n_trees:,} versions to the tree_version table")
+
+    print("--- updating name search indexes")
+    with engine.connect() as conn:
+        n_names = update_name_search(conn)
         conn.commit()
+    print(f"added {n_names:,} new names to the name search indexes")
     print("--- done")
 
 
@@ -1,6 +1,17 @@
+import sqlite3
 from datetime import datetime
 
-from sqlalchemy import DateTime, ForeignKey, Integer, Text, create_engine
+from sqlalchemy import (
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    PrimaryKeyConstraint,
+    Text,
+    create_engine,
+    text,
+)
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -9,32 +20,135 @@ class Base(DeclarativeBase):
 
 
 class TaxonomySource(Base):
+    """An imported taxdump. Its version is the ordinal of its date among all
+    imported taxdumps (0 for the oldest), which the other tables store instead
+    of dates."""
+
     __tablename__ = "taxonomy_source"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     path: Mapped[str] = mapped_column(Text)
     version_date: Mapped[datetime] = mapped_column(DateTime)
+    version: Mapped[int] = mapped_column(Integer)
 
     # Relationship to taxonomy records
     taxonomy_records: Mapped[list["Taxonomy"]] = relationship(back_populates="source")
 
 
 class Taxonomy(Base):
+    """One event in the history of a tax ID.
+
+    Tax IDs are stored as integers and rows are clustered on (tax_id,
+    version) in a WITHOUT ROWID table, so the history of a tax ID is a single
+    range of the primary key. Versions are the ordinals of taxonomy sources
+    (see TaxonomySource). Event IDs are assigned by the loader (there is no
+    rowid to autoincrement) and still give the insertion order.
+    """
+
     __tablename__ = "taxonomy"
 
-    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    id: Mapped[int] = mapped_column(Integer, unique=True)
     taxonomy_source_id: Mapped[int] = mapped_column(Integer, ForeignKey("taxonomy_source.id"))
     event_name: Mapped[str] = mapped_column(Text)
-    version_date: Mapped[datetime] = mapped_column(DateTime)
-    tax_id: Mapped[str] = mapped_column(Text)
-    parent_id: Mapped[str | None] = mapped_column(Text, nullable=True)
+    version: Mapped[int] = mapped_column(Integer)
+    tax_id: Mapped[int] = mapped_column(Integer)
+    parent_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
     rank: Mapped[str | None] = mapped_column(Text, nullable=True)
     name: Mapped[str | None] = mapped_column(Text, nullable=True)
-    merged_into_id: Mapped[str | None] = mapped_column(Text, nullable=True)
+    merged_into_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
 
     # Relationship to source
     source: Mapped[TaxonomySource] = relationship(back_populates="taxonomy_records")
 
+    # secondary indexes created by the migrations (the loader drops and
+    # recreates them around bulk loads). Entries of WITHOUT ROWID indexes
+    # include the primary key, so idx_parent_id also covers the tax IDs of
+    # children.
+    __table_args__ = (
+        PrimaryKeyConstraint("tax_id", "version", "id"),
+        Index("idx_parent_id", "parent_id", "version"),
+        Index("idx_name_version", "name", "version"),
+        Index(
+            "idx_merged_into_id",
+            "merged_into_id",
+            sqlite_where=text("merged_into_id IS NOT NULL"),
+        ),
+        Index("idx_version_tax_id", "version", "tax_id"),
+        {"sqlite_with_rowid": False},
+    )
+
+
+class TaxonomyState(Base):
+    """Validity interval of every taxonomy event. An event is the current state
+    of its tax ID from valid_from (its version) until valid_to (the version of
+    the tax ID's next event, or NULL if it is still current)."""
+
+    __tablename__ = "taxonomy_state"
+    __table_args__ = (
+        Index("idx_state_tax_id_valid", "tax_id", "valid_from", "valid_to"),
+        Index("idx_state_parent_id_valid", "parent_id", "valid_from", "valid_to"),
+    )
+
+    event_id: Mapped[int] = mapped_column(Integer, ForeignKey("taxonomy.id"), primary_key=True)
+    tax_id: Mapped[int] = mapped_column(Integer)
+    parent_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    event_name: Mapped[str] = mapped_column(Text)
+    valid_from: Mapped[int] = mapped_column(Integer)
+    valid_to: Mapped[int | None] = mapped_column(Integer, nullable=True)
+
+
+class LineageVersion(Base):
+    """Versions at which a tax ID's lineage changed, as returned by
+    TimeMachine.get_versions (see lineage_versions.py)"""
+
+    __tablename__ = "lineage_version"
+    __table_args__ = {"sqlite_with_rowid": False}
+
+    tax_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, primary_key=True)
+
+
+class NameSearch(Base):
+    """One row per distinct name in the taxonomy table pointing to the most
+    recent event with that name. Names are indexed for full-text search by the
+    name_search_fts table (see name_search.py).
+
+    The ID doubles as the sort key of search results: the length of the name
+    in the high 32 bits and the name's position among the names of the same
+    length in the low bits.
+    """
+
+    __tablename__ = "name_search"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    name: Mapped[str] = mapped_column(Text, unique=True)
+    event_id: Mapped[int] = mapped_column(Integer, ForeignKey("taxonomy.id"))
+
+
+class TreeVersion(Base):
+    """Preorder numbering of the taxonomy tree at every version, stored as
+    compressed arrays (see tree.py)"""
+
+    __tablename__ = "tree_version"
+
+    version: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    tax_ids: Mapped[bytes] = mapped_column(LargeBinary)
+    sizes: Mapped[bytes] = mapped_column(LargeBinary)
+    parent_offsets: Mapped[bytes] = mapped_column(LargeBinary)
+
+
+def read_version_dates(conn: sqlite3.Connection) -> list[datetime]:
+    """Read the date of every version, indexed by version ordinal"""
+    return [
+        datetime.fromisoformat(version_date)
+        for _, version_date in conn.execute(
+            """SELECT version, MIN(version_date)
+            FROM taxonomy_source
+            GROUP BY version
+            ORDER BY version"""
+        )
+    ]
+
 
 def create_db_engine(database_path: str):
     """Create SQLAlchemy engine for the given database path"""
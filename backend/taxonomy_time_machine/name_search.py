@@ -0,0 +1,278 @@
+import json
+from itertools import combinations, groupby, pairwise
+
+from sqlalchemy import Connection, text
+
+# external-content FTS index of name_search (rowid = name_search.id), so that
+# matches come out of the index already in search result order
+CREATE_FTS_TABLE = """
+    CREATE VIRTUAL TABLE name_search_fts
+    USING fts5(name, content='name_search', content_rowid='id')
+"""
+
+# trigram index of name_search for approximate matching (see
+# approximate_match_query)
+CREATE_TRIGRAM_TABLE = """
+    CREATE VIRTUAL TABLE name_trigram
+    USING fts5(name, content='name_search', content_rowid='id', tokenize='trigram')
+"""
+
+# name_search IDs are (length << POSITION_BITS) + position, where positions
+# follow name order and are spread evenly over the range so that new names can
+# be numbered in between without renumbering the others
+POSITION_BITS = 32
+
+# one row per name: the most recent event with that name (the one with the
+# smallest ID on ties, like update_name_search), numbered by (length, name)
+_NAME_SEARCH_ROWS = f"""
+    SELECT
+        (LENGTH(name) << {POSITION_BITS})
+            + ROW_NUMBER() OVER (PARTITION BY LENGTH(name) ORDER BY name)
+            * ((1 << {POSITION_BITS}) / (COUNT(*) OVER (PARTITION BY LENGTH(name)) + 1)),
+        name,
+        event_id
+    FROM (
+        SELECT name, id AS event_id, ROW_NUMBER() OVER (
+            PARTITION BY name ORDER BY version DESC, id
+        ) AS n
+        FROM taxonomy
+        WHERE name IS NOT NULL
+    )
+    WHERE n = 1
+"""
+
+
+def rebuild_name_search(conn: Connection) -> None:
+    """Recompute the name_search table and its full-text index from the
+    taxonomy table"""
+
+    conn.execute(text("DELETE FROM name_search"))
+    conn.execute(text(f"INSERT INTO name_search (id, name, event_id) {_NAME_SEARCH_ROWS}"))
+    conn.execute(text("INSERT INTO name_search_fts(name_search_fts) VALUES ('rebuild')"))
+    conn.execute(text("INSERT INTO name_trigram(name_trigram) VALUES ('rebuild')"))
+
+
+def rebuild_name_fts(conn: Connection) -> None:
+    """Recompute the name_fts index (used without the name_search table)"""
+
+    conn.execute(text("DELETE FROM name_fts"))
+    conn.execute(
+        text("INSERT INTO name_fts(name) SELECT DISTINCT name FROM taxonomy WHERE name IS NOT NULL")
+    )
+
+
+def optimize_name_search(conn: Connection) -> None:
+    """Merge the segments that incremental updates add to the full-text
+    indexes"""
+
+    for table in ("name_fts", "name_search_fts", "name_trigram"):
+        conn.execute(text(f"INSERT INTO {table}({table}) VALUES ('optimize')"))
+
+
+def _positions(count: int) -> list[int]:
+    # the positions _NAME_SEARCH_ROWS gives count names of the same length
+    gap = (1 << POSITION_BITS) // (count + 1)
+    return [gap * n for n in range(1, count + 1)]
+
+
+def _insert_names(conn: Connection, rows: list[tuple[int, str, int]]) -> None:
+    params = [{"id": id, "name": name, "event_id": event_id} for id, name, event_id in rows]
+    conn.execute(
+        text("INSERT INTO name_search (id, name, event_id) VALUES (:id, :name, :event_id)"),
+        params,
+    )
+    for table in ("name_search_fts", "name_trigram"):
+        conn.execute(text(f"INSERT INTO {table}(rowid, name) VALUES (:id, :name)"), params)
+
+
+def _delete_names(conn: Connection, rows: list[tuple[int, str, int]]) -> None:
+    params = [{"id": id, "name": name} for id, name, _ in rows]
+    for table in ("name_search_fts", "name_trigram"):
+        # external content indexes need the old values to delete them
+        conn.execute(
+            text(f"INSERT INTO {table}({table}, rowid, name) VALUES ('delete', :id, :name)"),
+            params,
+        )
+    conn.execute(text("DELETE FROM name_search WHERE id = :id"), params)
+
+
+def _number_new_names(conn: Connection, length: int, new_names: list[tuple[str, int]]) -> None:
+    """Insert names of one length into name_search, between the existing
+    names that sort around them. The whole length is renumbered if there is
+    no room left between two existing names."""
+
+    base = length << POSITION_BITS
+    existing = conn.execute(
+        text(
+            """SELECT id, name, event_id
+            FROM name_search
+            WHERE id BETWEEN :min_id AND :max_id
+            ORDER BY id"""
+        ),
+        {"min_id": base, "max_id": base + (1 << POSITION_BITS) - 1},
+    ).all()
+
+    # merge by name, then number each run of new names evenly between its
+    # existing neighbors
+    merged = sorted(
+        [(name, False, id, event_id) for id, name, event_id in existing]
+        + [(name, True, None, event_id) for name, event_id in new_names]
+    )
+
+    rows: list[tuple[int, str, int]] = []
+    previous_id = base
+    run: list[tuple[str, int]] = []
+    for name, is_new, id, event_id in [*merged, (None, False, base + (1 << POSITION_BITS), None)]:
+        if is_new:
+            run.append((name, event_id))
+            continue
+
+        if run:
+            step = (id - previous_id) // (len(run) + 1)
+            if step == 0:
+                break
+            rows.extend(
+                (previous_id + step * n, run_name, run_event_id)
+                for n, (run_name, run_event_id) in enumerate(run, 1)
+            )
+            run = []
+        previous_id = id
+    else:
+        _insert_names(conn, rows)
+        return
+
+    # no room: renumber all names of this length
+    _delete_names(conn, existing)
+    positions = _positions(len(merged))
+    _insert_names(
+        conn,
+        [
+            (base + position, name, event_id)
+            for position, (name, _, _, event_id) in zip(positions, merged, strict=True)
+        ],
+    )
+
+
+def update_name_search(conn: Connection) -> int:
+    """Update name_search, its full-text indexes and name_fts with the events
+    added to the taxonomy table since they were last updated (i.e. whose ID is
+    greater than any in name_search). Returns the number of new names.
+
+    Names that are new get a row (and are added to the indexes), and names
+    whose most recent event changed point to the new event. Rebuilds
+    everything if name_search is empty.
+    """
+
+    after_event_id = conn.execute(
+        text("SELECT COALESCE(MAX(event_id), 0) FROM name_search")
+    ).scalar()
+    if not after_event_id:
+        rebuild_name_search(conn)
+        rebuild_name_fts(conn)
+        return conn.execute(text("SELECT COUNT(*) FROM name_search")).scalar()
+
+    # the most recent of the new events with each name (the one with the
+    # smallest ID on ties, like _NAME_SEARCH_ROWS)
+    latest: dict[str, tuple[int, int]] = {}
+    for name, event_id, version in conn.execute(
+        text(
+            """SELECT name, id, version
+            FROM taxonomy
+            WHERE id > :after_event_id AND name IS NOT NULL
+            ORDER BY id"""
+        ),
+        {"after_event_id": after_event_id},
+    ):
+        if name not in latest or version > latest[name][0]:
+            latest[name] = (version, event_id)
+
+    existing = {
+        name: (version, event_id)
+        for name, event_id, version in conn.execute(
+            text(
+                """SELECT name_search.name, name_search.event_id, taxonomy.version
+                FROM name_search
+                JOIN taxonomy ON taxonomy.id = name_search.event_id
+                WHERE name_search.name IN (SELECT value FROM json_each(:names))"""
+            ),
+            {"names": json.dumps(list(latest))},
+        )
+    }
+
+    updated = [
+        {"name": name, "event_id": event_id}
+        for name, (version, event_id) in latest.items()
+        if name in existing and (version, -event_id) > (existing[name][0], -existing[name][1])
+    ]
+    if updated:
+        conn.execute(
+            text("UPDATE name_search SET event_id = :event_id WHERE name = :name"), updated
+        )
+
+    new_names = sorted(
+        (
+            (len(name), name, event_id)
+            for name, (_, event_id) in latest.items()
+            if name not in existing
+        )
+    )
+    for length, names in groupby(new_names, key=lambda row: row[0]):
+        _number_new_names(conn, length, [(name, event_id) for _, name, event_id in names])
+
+    if new_names:
+        conn.execute(
+            text("INSERT INTO name_fts(name) VALUES (:name)"),
+            [{"name": name} for _, name, _ in new_names],
+        )
+
+    return len(new_names)
+
+
+def approximate_match_query(query: str, max_distance: int) -> str | None:
+    """Return a trigram FTS query that matches every name within max_distance
+    edits of query (and more), or None if query is too short for that.
+
+    The query is split into up to 2 * max_distance + 1 pieces. Each edit
+    changes at most one piece, so any name within max_distance edits contains
+    all but max_distance of the pieces unchanged, and the FTS query requires
+    that many. Requiring more than one piece keeps common pieces (e.g.
+    "bacter") from matching most names. Pieces need at least 3 characters to
+    be looked up in the trigram index.
+    """
+    n_pieces = min(len(query) // 3, 2 * max_distance + 1)
+    n_required = n_pieces - max_distance
+    if n_required < 1:
+        return None
+
+    bounds = [len(query) * n // n_pieces for n in range(n_pieces + 1)]
+    phrases = [
+        '"{}"'.format(query[start:end].replace('"', '""')) for start, end in pairwise(bounds)
+    ]
+    groups = {" AND ".join(sorted(set(group))) for group in combinations(phrases, n_required)}
+    return " OR ".join(f"({group})" for group in sorted(groups))
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """Levenshtein distance between a and b, or max_distance + 1 if it is
+    greater than max_distance"""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(
+                min(
+                    previous[j] + 1,
+                    current[j - 1] + 1,
+                    previous[j - 1] + (char_a != char_b),
+                )
+            )
+
+        # distances never decrease from one row to the next
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+
+    return min(previous[-1], max_distance + 1)
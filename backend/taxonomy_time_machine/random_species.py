@@ -0,0 +1,130 @@
+import logging
+import random
+import sqlite3
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections.abc import Hashable
+
+from .event import EventName
+
+
+class SpeciesIndex:
+    """Tax IDs of all current species (tax IDs whose most recent event gives
+    them the rank "species") and their event counts, for sampling species
+    uniformly at random.
+
+    Species are sorted by event count, so the species with at least N events
+    are a suffix of the arrays that is found by bisection. Species whose
+    lineage changed at some point are also kept in a second pair of arrays.
+    """
+
+    def __init__(
+        self,
+        tax_ids: array,
+        event_counts: array,
+        changed_tax_ids: array,
+        changed_event_counts: array,
+    ):
+        self.tax_ids = tax_ids
+        self.event_counts = event_counts
+        self.changed_tax_ids = changed_tax_ids
+        self.changed_event_counts = changed_event_counts
+
+    def __len__(self) -> int:
+        return len(self.tax_ids)
+
+    @classmethod
+    def from_connection(
+        cls, conn: sqlite3.Connection, has_lineage_versions: bool = False
+    ) -> "SpeciesIndex":
+        # the bare columns come from the row with the MAX() version, i.e. the
+        # most recent event of each tax ID
+        rows = conn.execute(
+            """SELECT CAST(tax_id AS INTEGER), COUNT(*), MAX(version), rank, event_name
+            FROM taxonomy
+            GROUP BY tax_id"""
+        )
+        deleted = {EventName.Delete.value, EventName.Merge.value}
+        species = sorted(
+            (event_count, tax_id)
+            for tax_id, event_count, _, rank, event_name in rows
+            if rank == "species" and event_name not in deleted
+        )
+
+        if has_lineage_versions:
+            changed = {
+                int(tax_id)
+                for (tax_id,) in conn.execute(
+                    """SELECT tax_id FROM lineage_version
+                    GROUP BY tax_id
+                    HAVING COUNT(*) > 1"""
+                )
+            }
+            changed_species = [(n, tax_id) for n, tax_id in species if tax_id in changed]
+        else:
+            # without the lineage_version table, count species with more than
+            # one event (they changed, but not necessarily their lineage)
+            changed_species = [(n, tax_id) for n, tax_id in species if n > 1]
+
+        return cls(
+            tax_ids=array("i", (tax_id for _, tax_id in species)),
+            event_counts=array("i", (n for n, _ in species)),
+            changed_tax_ids=array("i", (tax_id for _, tax_id in changed_species)),
+            changed_event_counts=array("i", (n for n, _ in changed_species)),
+        )
+
+    def _arrays(self, changed_lineage: bool) -> tuple[array, array]:
+        if changed_lineage:
+            return self.changed_tax_ids, self.changed_event_counts
+        return self.tax_ids, self.event_counts
+
+    def count(self, min_event_count: int = 1, changed_lineage: bool = False) -> int:
+        """Number of species matching the filters"""
+        _, event_counts = self._arrays(changed_lineage)
+        return len(event_counts) - bisect_left(event_counts, min_event_count)
+
+    def sample(
+        self,
+        min_event_count: int = 1,
+        changed_lineage: bool = False,
+        rng: random.Random | None = None,
+    ) -> tuple[str, int] | None:
+        """Return the tax ID and event count of a species chosen uniformly at
+        random among those with at least min_event_count events (and a lineage
+        that changed), or None if there are no such species"""
+        tax_ids, event_counts = self._arrays(changed_lineage)
+        start = bisect_left(event_counts, min_event_count)
+
+        if start == len(tax_ids):
+            return None
+
+        row = (rng or random).randrange(start, len(tax_ids))
+        return str(tax_ids[row]), event_counts[row]
+
+
+# one index per database, replaced when the data version changes
+_indexes: dict[Hashable, tuple[Hashable, SpeciesIndex]] = {}
+_indexes_lock = threading.Lock()
+
+
+def load_species_index(
+    conn: sqlite3.Connection,
+    database: Hashable,
+    data_version: Hashable,
+    has_lineage_versions: bool = False,
+) -> SpeciesIndex:
+    """Load the SpeciesIndex of a database once per data version and share it
+    between threads"""
+    with _indexes_lock:
+        entry = _indexes.get(database)
+
+        if entry is None or entry[0] != data_version:
+            _profile_start = time.perf_counter()
+            index = SpeciesIndex.from_connection(conn, has_lineage_versions=has_lineage_versions)
+            elapsed = time.perf_counter() - _profile_start
+            logging.info(f"indexed {len(index):,} species in {elapsed:.2f} s")
+            entry = _indexes[database] = (data_version, index)
+
+        return entry[1]
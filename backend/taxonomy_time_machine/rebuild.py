@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Recompute the tables that the loader derives from the taxonomy table, e.g.
+for databases created before those tables existed."""
+
+import argparse
+import sqlite3
+import time
+from contextlib import closing
+
+from sqlalchemy import create_engine
+
+from .lineage_versions import rebuild_lineage_versions
+from .name_search import optimize_name_search, rebuild_name_fts, rebuild_name_search
+from .state import rebuild_state_table
+from .tree_versions import rebuild_tree_versions
+
+
+def rebuild_state(db_path: str) -> None:
+    engine = create_engine(f"sqlite:///{db_path}")
+    with engine.connect() as conn:
+        rebuild_state_table(conn)
+        conn.commit()
+
+
+def rebuild_versions(db_path: str) -> None:
+    with closing(sqlite3.connect(db_path)) as conn:
+        n_rows = rebuild_lineage_versions(conn)
+    print(f"lineage_version table now has {n_rows:,} rows")
+
+
+def rebuild_search(db_path: str) -> None:
+    engine = create_engine(f"sqlite:///{db_path}")
+    with engine.connect() as conn:
+        rebuild_name_search(conn)
+        conn.commit()
+
+
+def rebuild_fts(db_path: str) -> None:
+    # full rebuild of every name index, e.g. after many incremental loads
+    engine = create_engine(f"sqlite:///{db_path}")
+    with engine.connect() as conn:
+        rebuild_name_fts(conn)
+        rebuild_name_search(conn)
+        optimize_name_search(conn)
+        conn.commit()
+
+
+def rebuild_trees(db_path: str) -> None:
+    with closing(sqlite3.connect(db_path)) as conn:
+        n_versions = rebuild_tree_versions(conn)
+    print(f"tree_version table now has {n_versions:,} versions")
+
+
+TABLES = {
+    "state": rebuild_state,
+    "versions": rebuild_versions,
+    "search": rebuild_search,
+    "fts": rebuild_fts,
+    "trees": rebuild_trees,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--db-path",
+        required=True,
+        type=str,
+        help="path to sqlite database",
+    )
+    parser.add_argument("tables", nargs="+", choices=list(TABLES), help="tables to rebuild")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+
+    for table in args.tables:
+        print(f"--- rebuilding {table}")
+        start = time.perf_counter()
+        TABLES[table](args.db_path)
+        print(f"--- rebuilt {table} in {time.perf_counter() - start:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+from collections.abc import Callable, Iterable, Iterator
+
+from .event import Event
+
+# number of lines joined into each chunk of output
+CHUNK_SIZE = 10_000
+
+
+def _tsv_line(event: Event) -> str:
+    return f"{event.tax_id}\t{event.parent_id or ''}\t{event.rank or ''}\t{event.name or ''}\n"
+
+
+def _nodes_line(event: Event) -> str:
+    # NCBI's root is its own parent. Columns after the rank (division, genetic
+    # codes, ...) aren't tracked, so they are left empty.
+    parent_id = event.parent_id or event.tax_id
+    return f"{event.tax_id}\t|\t{parent_id}\t|\t{event.rank or ''}\t|" + "\t\t|" * 10 + "\n"
+
+
+def _names_line(event: Event) -> str:
+    return f"{event.tax_id}\t|\t{event.name or ''}\t|\t\t|\tscientific name\t|\n"
+
+
+# output format -> (header, line formatter)
+FORMATS: dict[str, tuple[str, Callable[[Event], str]]] = {
+    "tsv": ("tax_id\tparent_id\trank\tname\n", _tsv_line),
+    "nodes": ("", _nodes_line),
+    "names": ("", _names_line),
+}
+
+
+def format_snapshot(events: Iterable[Event], format: str = "tsv") -> Iterator[str]:
+    """Format a taxonomy snapshot (see TimeMachine.iter_snapshot) as TSV or as
+    NCBI nodes.dmp/names.dmp lines, yielding chunks of CHUNK_SIZE lines"""
+    header, format_line = FORMATS[format]
+
+    chunk = [header] if header else []
+    for event in events:
+        chunk.append(format_line(event))
+        if len(chunk) >= CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk = []
+
+    if chunk:
+        yield "".join(chunk)
@@ -0,0 +1,48 @@
+from sqlalchemy import Connection, text
+
+# every event of the selected tax IDs, along with the version of the tax ID's
+# next event (when it stopped being current)
+_STATE_ROWS = """
+    SELECT
+        id,
+        tax_id,
+        parent_id,
+        event_name,
+        version,
+        LEAD(version) OVER (PARTITION BY tax_id ORDER BY version, id)
+    FROM taxonomy
+"""
+
+
+def rebuild_state_table(conn: Connection) -> None:
+    """Recompute the validity interval of every event in the taxonomy table"""
+
+    conn.execute(text("DELETE FROM taxonomy_state"))
+    conn.execute(
+        text(
+            f"""INSERT INTO taxonomy_state
+            (event_id, tax_id, parent_id, event_name, valid_from, valid_to)
+            {_STATE_ROWS}"""
+        )
+    )
+
+
+def update_state_table(conn: Connection, after_event_id: int) -> None:
+    """Recompute the validity intervals of all tax IDs that have events with an
+    ID greater than after_event_id (i.e., events that were just inserted)"""
+
+    updated_tax_ids = "SELECT DISTINCT tax_id FROM taxonomy WHERE id > :after_event_id"
+
+    conn.execute(
+        text(f"DELETE FROM taxonomy_state WHERE tax_id IN ({updated_tax_ids})"),
+        {"after_event_id": after_event_id},
+    )
+    conn.execute(
+        text(
+            f"""INSERT INTO taxonomy_state
+            (event_id, tax_id, parent_id, event_name, valid_from, valid_to)
+            {_STATE_ROWS}
+            WHERE tax_id IN ({updated_tax_ids})"""
+        ),
+        {"after_event_id": after_event_id},
+    )
@@ -1,18 +1,161 @@
+import json
 import logging
+import os
 import sqlite3
 import time
+import uuid
+from array import array
+from bisect import bisect_right
+from collections import Counter
+from collections.abc import Iterator
 from datetime import datetime
-from functools import lru_cache
+from itertools import groupby, islice
+from pathlib import Path
 from typing import Literal
 
+from .cache import MISSING, ResultCache, cached, shared_cache
+from .diff import Change, diff_tax_ids_cache, net_change
 from .event import Event, EventName
+from .models import read_version_dates
+from .name_search import POSITION_BITS, approximate_match_query, edit_distance
+from .random_species import SpeciesIndex, load_species_index
+from .tree import TaxonomyTree, tree_cache
+
+# approximate name search: the maximum number of edits between a query and the
+# names it matches, and the maximum number of candidate names compared with it
+MAX_EDIT_DISTANCE = int(os.environ.get("TTM_SEARCH_MAX_EDIT_DISTANCE", "2"))
+MAX_CANDIDATES = int(os.environ.get("TTM_SEARCH_MAX_CANDIDATES", "1000"))
+
+
+def connect_read_only(database_path: str) -> sqlite3.Connection:
+    """Open a database for serving: read-only, and immutable if
+    TTM_SQLITE_IMMUTABLE=1, so that SQLite skips locking and change detection
+    entirely. Page cache, mmap and temp store sizes can be tuned with
+    environment variables.
+
+    NOTE: an immutable database must not be modified while it is open, and
+    changes to it are never seen (neither by cache invalidation nor by ETags);
+    restart the server after loading new taxdumps.
+    """
+    uri = f"{Path(database_path).resolve().as_uri()}?mode=ro"
+
+    if os.environ.get("TTM_SQLITE_IMMUTABLE", "0") == "1":
+        uri += "&immutable=1"
+
+    conn = sqlite3.connect(uri, uri=True)
+
+    # memory-map up to this many bytes of the database (default: 1 GiB)
+    mmap_size = int(os.environ.get("TTM_SQLITE_MMAP_SIZE", "1073741824"))
+    # page cache size: pages if positive, KiB if negative (default: 64 MiB)
+    cache_size = int(os.environ.get("TTM_SQLITE_CACHE_SIZE", "-65536"))
+    # where temporary tables and indices are kept: default, file or memory
+    temp_store = os.environ.get("TTM_SQLITE_TEMP_STORE", "memory")
+
+    if temp_store.lower() not in {"default", "file", "memory"}:
+        raise ValueError(f"Invalid TTM_SQLITE_TEMP_STORE: {temp_store}")
+
+    conn.execute(f"PRAGMA mmap_size = {mmap_size}")
+    conn.execute(f"PRAGMA cache_size = {cache_size}")
+    conn.execute(f"PRAGMA temp_store = {temp_store}")
+
+    return conn
 
 
 class TimeMachine:
-    def __init__(self, database_path: str = "events.db"):
-        self.conn = sqlite3.connect(database_path)
+    def __init__(self, database_path: str = "events.db", read_only: bool = False):
+        self.database_path: str | None = database_path
+
+        if read_only:
+            self._connect(connect_read_only(database_path))
+        else:
+            self._connect(sqlite3.connect(database_path))
+
+    @classmethod
+    def from_connection(cls, conn: sqlite3.Connection) -> "TimeMachine":
+        """Create a TimeMachine that queries an already-open connection"""
+        time_machine = cls.__new__(cls)
+        time_machine.database_path = None
+        time_machine._connect(conn)
+        return time_machine
+
+    def _connect(self, conn: sqlite3.Connection):
+        # NOTE: every query uses its own cursor (via conn.execute) so that
+        # nested/interleaved queries never clobber each other's results
+        self.conn = conn
         self.conn.row_factory = sqlite3.Row  # return Row instead of tuple
-        self.cursor = self.conn.cursor()
+
+        # results are cached process-wide, keyed by cache_namespace()
+        self.cache: ResultCache | None = shared_cache
+        # identifies this instance in cache keys when there is no database
+        # path. Unlike id(self.conn) it is never reused, and unlike the
+        # connection itself it doesn't keep the connection alive.
+        self._cache_token = uuid.uuid4().hex
+        self._sqlite_data_version: int | None = None
+        self._data_version = ""
+        self._version_dates: list[datetime] = []
+
+        tables = {
+            r["name"]
+            for r in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        }
+
+        # optional tables maintained by the loader (see state.py and
+        # lineage_versions.py)
+        self.has_state_table = "taxonomy_state" in tables
+        self.has_name_search = "name_search" in tables
+        self.has_name_trigram = "name_trigram" in tables
+        self.has_tree_versions = (
+            "tree_version" in tables
+            and self.conn.execute("SELECT 1 FROM tree_version LIMIT 1").fetchone() is not None
+        )
+        self.has_lineage_versions = (
+            "lineage_version" in tables
+            and self.conn.execute("SELECT 1 FROM lineage_version LIMIT 1").fetchone() is not None
+        )
+
+    @property
+    def data_version(self) -> str:
+        """Identifies the data currently in the database: the ID and date of
+        the most recently imported taxonomy source"""
+        self._refresh_data_version()
+        return self._data_version
+
+    @property
+    def version_dates(self) -> list[datetime]:
+        """The date of every version, indexed by the version ordinals stored in
+        the taxonomy table"""
+        self._refresh_data_version()
+        return self._version_dates
+
+    def _refresh_data_version(self) -> None:
+        """Re-read the data version and version dates if the database changed"""
+
+        # PRAGMA data_version changes whenever another connection commits, so
+        # the taxonomy_source table is only re-read after the database changed
+        sqlite_data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+        if sqlite_data_version != self._sqlite_data_version:
+            row = self.conn.execute(
+                "SELECT id, version_date FROM taxonomy_source ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+            self._data_version = "" if row is None else f"{row['id']}-{row['version_date']}"
+            self._version_dates = read_version_dates(self.conn)
+            self._sqlite_data_version = sqlite_data_version
+
+    def _version(self, as_of: datetime) -> int:
+        """Return the ordinal of the last version up to as_of (-1 if as_of is
+        before the first version)"""
+        return bisect_right(self.version_dates, as_of) - 1
+
+    def _events(self, rows) -> list[Event]:
+        """Build events from taxonomy rows (see Event.from_row)"""
+        version_dates = self.version_dates
+        return [Event.from_row(r, version_dates) for r in rows]
+
+    def cache_namespace(self) -> tuple:
+        """Cache keys are namespaced by database and data version so that
+        reloading the database invalidates previously cached results"""
+        return (self.database_path or self._cache_token, self.data_version)
 
     def _profile(self, func_name: str, start: float, end: float):
         elapsed = (end - start) * 1000  # ms
@@ -28,7 +171,7 @@ class TimeMachine:
     def _safe_fts_query(self, sql: str, params: tuple):
         """Execute FTS query with fallback to empty results on syntax errors"""
         try:
-            return self.cursor.execute(sql, params).fetchall()
+            return self.conn.execute(sql, params).fetchall()
         except sqlite3.OperationalError as e:
             if "fts5: syntax error" in str(e).lower():
                 logging.warning(
@@ -39,78 +182,59 @@ class TimeMachine:
                 # Re-raise other operational errors
                 raise
 
-    @lru_cache(maxsize=128)
+    @cached
     def search_names(self, query: str, limit: int | None = 10) -> list[Event]:
         _profile_start = time.perf_counter()
-        matches: list[dict] = []
-        exact_matches: list[dict] = []
+        matches: list[sqlite3.Row] = []
+        exact_matches: list[sqlite3.Row] = []
 
         # first, check if the query is tax-ID like
         if query.isnumeric():
             _q1_start = time.perf_counter()
-            rows = self.cursor.execute(
+            rows = self.conn.execute(
                 """SELECT *
                 FROM taxonomy
                 WHERE tax_id = ?
-                ORDER BY version_date desc
+                ORDER BY version desc
                 LIMIT 1""",
                 (query,),
             ).fetchall()
             _q1_end = time.perf_counter()
             self._profile("search_names:taxid_query", _q1_start, _q1_end)
 
-            exact_matches.extend([dict(r) for r in rows])
+            exact_matches.extend(rows)
 
-        if limit is None or (len(matches) + len(exact_matches) < limit):
-            # Use FTS for prefix matches instead of slow LIKE query
+        if not self.has_name_search:
+            matches.extend(self._search_names_fts(query, n_matches=len(exact_matches), limit=limit))
+
+        elif limit is None or len(exact_matches) < limit:
+            # prefix matches, already ranked and deduplicated by the index
             _q2_start = time.perf_counter()
-            prefix_rows = [
-                dict(r)
-                for r in self._safe_fts_query(
-                    """
-                    SELECT *
-                    FROM name_fts
-                    JOIN taxonomy ON name_fts.name = taxonomy.name
-                    WHERE name_fts MATCH ?
-                    ORDER BY LENGTH(taxonomy.name) ASC
-                    LIMIT ?
-                    ;
-                    """,
-                    (f"{self._escape_fts_phrase(query)}*", 10),
-                )
-            ]
-            _q2_end = time.perf_counter()
-            self._profile("search_names:prefix_query", _q2_start, _q2_end)
+            prefix_rows = self._safe_fts_query(
+                """
+                SELECT taxonomy.*
+                FROM name_search_fts
+                JOIN name_search ON name_search.id = name_search_fts.rowid
+                JOIN taxonomy ON taxonomy.id = name_search.event_id
+                WHERE name_search_fts MATCH ?
+                ORDER BY name_search_fts.rowid
+                LIMIT ?
+                """,
+                (f"{self._escape_fts_phrase(query)}*", -1 if limit is None else limit),
+            )
+            self._profile("search_names:prefix_query", _q2_start, time.perf_counter())
             matches.extend(prefix_rows)
 
-        if limit is None or (len(matches) + len(exact_matches)) < limit:
-            # fuzzy matches
-            _q3_start = time.perf_counter()
-            fuzzy_rows = [
-                dict(r)
-                for r in self._safe_fts_query(
-                    """
-                    SELECT taxonomy.tax_id, taxonomy.name, taxonomy.rank, taxonomy.event_name, taxonomy.version_date
-                    FROM name_fts
-                    JOIN taxonomy ON name_fts.name = taxonomy.name
-                    WHERE name_fts MATCH ?
-                    ORDER BY LENGTH(taxonomy.name) ASC
-                    LIMIT ?
-                    ;
-                    """,
-                    (self._escape_fts_phrase(query), 10),
-                )
-            ]
-            _q3_end = time.perf_counter()
-            self._profile("search_names:fuzzy_query", _q3_start, _q3_end)
-            matches.extend(fuzzy_rows)
-
         # sort by closest match (probably the shortest)
         matches = sorted(matches, key=lambda m: len(m["name"]))
 
         # exact matches should always come first
         # + convert to Events
-        events = [Event.from_dict(m) for m in (exact_matches + matches)]
+        events = self._events(exact_matches + matches)
+
+        if limit is None or len(events) < limit:
+            # misspelled names
+            events.extend(self.search_names_approximate(query, limit=limit))
 
         # deduplicate by name, taking most-recent
         name_to_event: dict[str, Event] = {}
@@ -129,7 +253,146 @@ class TimeMachine:
         self._profile("search_names", _profile_start, time.perf_counter())
         return events
 
-    @lru_cache(maxsize=256)
+    @cached
+    def search_names_approximate(
+        self, query: str, max_distance: int = MAX_EDIT_DISTANCE, limit: int | None = 10
+    ) -> list[Event]:
+        """Find names within max_distance edits of query (ignoring case),
+        closest first. Queries too short for max_distance are matched with
+        fewer edits."""
+        if not self.has_name_trigram:
+            return []
+
+        _profile_start = time.perf_counter()
+
+        max_distance = min(max_distance, len(query) // 3 - 1)
+        fts_query = approximate_match_query(query, max_distance) if max_distance >= 0 else None
+        if fts_query is None:
+            return []
+
+        # matches differ in length by at most max_distance characters and
+        # name_search IDs are ordered by length
+        min_id = max(len(query) - max_distance, 0) << POSITION_BITS
+        max_id = ((len(query) + max_distance + 1) << POSITION_BITS) - 1
+
+        # candidates come out of the index in ID order, so the scan stops after
+        # MAX_CANDIDATES matches instead of ranking every match
+        candidates = self._safe_fts_query(
+            """SELECT rowid, name
+            FROM name_trigram
+            WHERE name_trigram MATCH ? AND rowid BETWEEN ? AND ?
+            LIMIT ?""",
+            (fts_query, min_id, max_id, MAX_CANDIDATES),
+        )
+
+        query = query.lower()
+        distances = sorted(
+            (distance, name_id)
+            for name_id, name in candidates
+            if (distance := edit_distance(query, name.lower(), max_distance)) <= max_distance
+        )[:limit]
+
+        rows = self.conn.execute(
+            """SELECT name_search.id AS name_search_id, taxonomy.*
+            FROM name_search
+            JOIN taxonomy ON taxonomy.id = name_search.event_id
+            WHERE name_search.id IN (SELECT value FROM json_each(?))""",
+            (json.dumps([name_id for _, name_id in distances]),),
+        )
+        version_dates = self.version_dates
+        events = {r["name_search_id"]: Event.from_row(r, version_dates) for r in rows}
+
+        self._profile("search_names_approximate", _profile_start, time.perf_counter())
+        return [events[name_id] for _, name_id in distances]
+
+    def _search_names_fts(self, query: str, n_matches: int, limit: int | None) -> list[sqlite3.Row]:
+        """Prefix and phrase matches from the name_fts index, for databases
+        without the name_search table"""
+        matches: list[sqlite3.Row] = []
+
+        if limit is None or (len(matches) + n_matches < limit):
+            # Use FTS for prefix matches instead of slow LIKE query
+            _q2_start = time.perf_counter()
+            prefix_rows = self._safe_fts_query(
+                """
+                SELECT taxonomy.*
+                FROM name_fts
+                JOIN taxonomy ON name_fts.name = taxonomy.name
+                WHERE name_fts MATCH ?
+                ORDER BY LENGTH(taxonomy.name) ASC
+                LIMIT ?
+                ;
+                """,
+                (f"{self._escape_fts_phrase(query)}*", 10),
+            )
+            _q2_end = time.perf_counter()
+            self._profile("search_names:prefix_query", _q2_start, _q2_end)
+            matches.extend(prefix_rows)
+
+        if limit is None or (len(matches) + n_matches) < limit:
+            # fuzzy matches
+            _q3_start = time.perf_counter()
+            fuzzy_rows = self._safe_fts_query(
+                """
+                SELECT taxonomy.*
+                FROM name_fts
+                JOIN taxonomy ON name_fts.name = taxonomy.name
+                WHERE name_fts MATCH ?
+                ORDER BY LENGTH(taxonomy.name) ASC
+                LIMIT ?
+                ;
+                """,
+                (self._escape_fts_phrase(query), 10),
+            )
+            _q3_end = time.perf_counter()
+            self._profile("search_names:fuzzy_query", _q3_start, _q3_end)
+            matches.extend(fuzzy_rows)
+
+        return matches
+
+    def search_names_batch(
+        self, queries: list[str], exact: bool = True, limit: int | None = 10
+    ) -> dict[str, list[Event]]:
+        """Search for many names at once.
+
+        If `exact` is set, all queries are first resolved to the most recent
+        event carrying exactly that name using a single set-based query. Only
+        the queries without an exact match fall back to `search_names`.
+        """
+        _profile_start = time.perf_counter()
+        results: dict[str, list[Event]] = {}
+
+        if exact and self.has_name_search:
+            rows = self.conn.execute(
+                """SELECT taxonomy.*
+                FROM name_search
+                JOIN taxonomy ON taxonomy.id = name_search.event_id
+                WHERE name_search.name IN (SELECT value FROM json_each(?))""",
+                (json.dumps(list(set(queries))),),
+            ).fetchall()
+            results.update({e.name: [e] for e in self._events(rows)})
+
+        elif exact:
+            # SQLite returns the bare columns from the row holding MAX(version)
+            rows = self.conn.execute(
+                """SELECT taxonomy.*, MAX(taxonomy.version) AS latest_version
+                FROM taxonomy
+                WHERE taxonomy.name IN (SELECT value FROM json_each(?))
+                GROUP BY taxonomy.name""",
+                (json.dumps(list(set(queries))),),
+            ).fetchall()
+            results.update({e.name: [e] for e in self._events(rows)})
+
+        self._profile("search_names_batch:exact_query", _profile_start, time.perf_counter())
+
+        for query in queries:
+            if query not in results:
+                results[query] = self.search_names(query=query, limit=limit)
+
+        self._profile("search_names_batch", _profile_start, time.perf_counter())
+        return results
+
+    @cached
     def get_events(
         self,
         tax_id: str,
@@ -140,90 +403,138 @@ class TimeMachine:
         query_key (default='tax_id')"""
         _profile_start = time.perf_counter()
 
-        if query_key == "tax_id":
-            self.cursor.execute("SELECT * FROM taxonomy WHERE tax_id = ?;", (tax_id,))
-        elif query_key == "parent_id":
-            self.cursor.execute("SELECT * FROM taxonomy WHERE parent_id = ?;", (tax_id,))
-        else:
+        if query_key not in ("tax_id", "parent_id"):
             raise Exception(f"Unable to use handle {query_key=}")
 
-        rows = [Event.from_dict(dict(r)) for r in self.cursor.fetchall()]
-
-        if as_of:
-            rows = [r for r in rows if r.version_date <= as_of]
+        # read once: lineages call this for every ancestor
+        version_dates = self.version_dates
+
+        # the events up to as_of are a range of the primary key (tax_id,
+        # version) or of idx_parent_id (parent_id, version)
+        rows = self.conn.execute(
+            f"""SELECT *
+            FROM taxonomy
+            WHERE {query_key} = ? {"AND version <= ?" if as_of else ""}
+            ORDER BY version""",
+            (tax_id, bisect_right(version_dates, as_of) - 1) if as_of else (tax_id,),
+        )
 
-        result = sorted(rows, key=lambda r: r.version_date)
+        result = [Event.from_row(r, version_dates) for r in rows]
         self._profile("get_events", _profile_start, time.perf_counter())
         return result
 
-    @lru_cache(maxsize=256)
+    @cached
     def get_children(self, tax_id: str, as_of: datetime | None = None):
         """Get all children of a node at a given version"""
 
         _profile_start = time.perf_counter()
 
-        # 1. find all? rows where parent_id=query_tax_id using their tax_ids
-        # ....
-
-        # find all create/alter events where parent_id = tax_id and
-        # version_date <= as_of
-        parent_events = self.get_events(tax_id=tax_id, as_of=as_of, query_key="parent_id")
+        if self.has_state_table:
+            rows = self._get_children_from_state(tax_id=tax_id, as_of=as_of)
+            self._profile("get_children", _profile_start, time.perf_counter())
+            return rows
+
+        # the full history (up to as_of) of every tax ID that has ever been a
+        # child of tax_id
+        histories = self._get_child_histories(tax_id=tax_id, as_of=as_of)
+
+        # a taxon is a child if its most recent event still points to tax_id.
+        # this excludes children that moved to a new parent, and children that
+        # were deleted/merged (unless they were re-created under tax_id)
+        rows = []
+        for events in histories.values():
+            last_event = events[-1]
+            if last_event.parent_id == tax_id and last_event.event_name not in {
+                EventName.Delete,
+                EventName.Merge,
+            }:
+                rows.append(last_event)
 
-        # 2. find most recent event by tax ID and make sure that the parent is
-        # *still* query_tax_id. remove these rows
-
-        child_tax_ids = {e.tax_id for e in parent_events}
-        unused_tax_ids = {
-            e.tax_id
-            for e in parent_events
-            if (e.event_name is EventName.Delete) or (e.event_name is EventName.Merge)
-        }
-        child_events = []
-
-        # TODO: do this in a single db query
-        for child_tax_id in child_tax_ids:
-            if ee := self.get_events(tax_id=child_tax_id, as_of=as_of, query_key="tax_id"):
-                last_event = ee[-1]
+        self._profile("get_children", _profile_start, time.perf_counter())
+        return rows
 
-                # catch tax IDs that were deleted/merged then re-created
-                if (
-                    last_event.event_name not in {EventName.Delete, EventName.Merge}
-                    and last_event.tax_id in unused_tax_ids
-                ):
-                    unused_tax_ids.remove(last_event.tax_id)
+    def _get_children_from_state(self, tax_id: str, as_of: datetime | None = None) -> list[Event]:
+        """Get the children of a node with a range lookup on the taxonomy_state
+        table. Children are ordered by their first event under tax_id, like
+        get_children orders them."""
+        rows = self.conn.execute(
+            f"""SELECT taxonomy.*
+            FROM taxonomy_state
+            JOIN taxonomy ON taxonomy.id = taxonomy_state.event_id
+            JOIN taxonomy AS first_event ON first_event.id = (
+                SELECT t.id
+                FROM taxonomy AS t
+                WHERE t.tax_id = taxonomy_state.tax_id AND t.parent_id = taxonomy_state.parent_id
+                ORDER BY t.version, t.id
+                LIMIT 1
+            )
+            WHERE taxonomy_state.parent_id = :tax_id
+            AND {self._state_as_of_filter(as_of)}
+            AND taxonomy_state.event_name NOT IN ('delete', 'merge')
+            ORDER BY first_event.version, first_event.id""",
+            {"tax_id": tax_id, "as_of": as_of and self._version(as_of)},
+        ).fetchall()
+
+        return self._events(rows)
+
+    def _get_state(self, tax_id: str, as_of: datetime | None = None) -> Event | None:
+        """Get the event that was current for a tax ID as of a given date using
+        the taxonomy_state table"""
+        version_dates = self.version_dates
+        row = self.conn.execute(
+            f"""SELECT taxonomy.*
+            FROM taxonomy_state
+            JOIN taxonomy ON taxonomy.id = taxonomy_state.event_id
+            WHERE taxonomy_state.tax_id = :tax_id
+            AND {self._state_as_of_filter(as_of)}""",
+            {"tax_id": tax_id, "as_of": as_of and bisect_right(version_dates, as_of) - 1},
+        ).fetchone()
+
+        return None if row is None else Event.from_row(row, version_dates)
+
+    def _state_as_of_filter(self, as_of: datetime | None) -> str:
+        """SQL condition selecting the taxonomy_state rows current as of the
+        version :as_of"""
+        if as_of is None:
+            return "taxonomy_state.valid_to IS NULL"
+        return (
+            "taxonomy_state.valid_from <= :as_of"
+            " AND (taxonomy_state.valid_to IS NULL OR taxonomy_state.valid_to > :as_of)"
+        )
 
-                child_events.append(ee[-1])
+    def _get_child_histories(
+        self, tax_id: str, as_of: datetime | None = None
+    ) -> dict[str, list[Event]]:
+        """Get the events (up to as_of) of every tax ID that has had tax_id as
+        its parent, in a single query.
 
-        keep_tax_ids = {c.tax_id for c in child_events if c.parent_id == tax_id}
-        events = [e for e in parent_events if e.tax_id in keep_tax_ids]
+        Tax IDs are ordered by their first event under tax_id and only include
+        tax IDs that had such an event by as_of.
+        """
+        rows = self.conn.execute(
+            """SELECT *
+            FROM taxonomy
+            WHERE tax_id IN (SELECT tax_id FROM taxonomy WHERE parent_id = ?)
+            ORDER BY version, id""",
+            (tax_id,),
+        ).fetchall()
 
-        # 3. remove any deleted rows
-        events = [e for e in events if e.tax_id not in unused_tax_ids]
-        # for each tax ID, get the *latest* parent_id
-        # if that parent_id == tax_id then keep it
+        if as_of:
+            version = self._version(as_of)
+            rows = [r for r in rows if r["version"] <= version]
 
-        # NOTE: it's faster to do this in Python than in SQL at least with the
-        # queries I tried.
+        events = self._events(rows)
 
-        latest_row_by_tax_id: dict[str, Event] = {}
+        histories: dict[str, list[Event]] = {}
         for event in events:
-            if event.tax_id not in latest_row_by_tax_id or (
-                event.version_date >= latest_row_by_tax_id[event.tax_id].version_date
-            ):
-                latest_row_by_tax_id[event.tax_id] = event
+            if event.parent_id == tax_id and event.tax_id not in histories:
+                histories[event.tax_id] = []
 
-        # if the taxon moved then we can't find it by parent ID because it has
-        # a new parent ID... so we need to look up each individual taxon's
-        # events to check for moves and deletions...
-
-        # make sure the row is still a child of tax_id
-        rows = [r for r in latest_row_by_tax_id.values() if r.parent_id == tax_id]
-
-        # remove anything that got deleted/merged
-        rows = [r for r in rows if r.event_name not in {EventName.Delete, EventName.Merge}]
+        for event in events:
+            if event.tax_id in histories:
+                histories[event.tax_id].append(event)
 
-        self._profile("get_children", _profile_start, time.perf_counter())
-        return rows
+        return histories
 
     def get_all_events_recursive(self, tax_id: str) -> list[Event]:
         _profile_start = time.perf_counter()
@@ -231,12 +542,21 @@ class TimeMachine:
         self._profile("get_all_events_recursive", _profile_start, time.perf_counter())
         return result
 
-    @lru_cache(maxsize=256)
+    @cached
     def get_versions(self, tax_id: str) -> list[datetime]:
         """Get the collapsed list of dates at which a taxon's lineage
         changed"""
         _profile_start = time.perf_counter()
 
+        if self.has_lineage_versions:
+            rows = self.conn.execute(
+                "SELECT version FROM lineage_version WHERE tax_id = ? ORDER BY version",
+                (tax_id,),
+            ).fetchall()
+            self._profile("get_versions", _profile_start, time.perf_counter())
+            version_dates = self.version_dates
+            return [version_dates[r["version"]] for r in rows]
+
         # Find deletion/merge date for this taxon (if deleted or merged)
         own_events = self.get_events(tax_id=tax_id)
         deletion_date = None
@@ -275,7 +595,7 @@ class TimeMachine:
         self._profile("get_versions", _profile_start, time.perf_counter())
         return versions_with_changes
 
-    @lru_cache(maxsize=256)
+    @cached
     def get_lineage(self, tax_id: str, as_of: datetime | None = None):
         """
         Given a tax_id: return the taxonomy lineage. If `as_of` is specified,
@@ -286,30 +606,9 @@ class TimeMachine:
         lineage = []
 
         while True:
-            events = self.get_events(tax_id=tax_id, as_of=as_of)
-
-            # find most recent event where the parent_id changed
-            parent = None
-            for event in events[::-1]:
-                if event.parent_id:
-                    parent = event
-                    break
+            parent = self._get_lineage_entry(tax_id=tax_id, as_of=as_of)
 
             if parent is not None:
-                if (parent.event_name == EventName.Delete) or (
-                    parent.event_name == EventName.Merge
-                ):
-                    last_known = next((e for e in reversed(events) if e.name), None)
-                    if last_known:
-                        parent = Event(
-                            event_name=parent.event_name,
-                            tax_id=parent.tax_id,
-                            version_date=parent.version_date,
-                            name=last_known.name,
-                            rank=last_known.rank,
-                            parent_id=parent.parent_id,
-                            merged_into_id=parent.merged_into_id,
-                        )
                 lineage.append(parent)
             else:
                 break
@@ -322,19 +621,315 @@ class TimeMachine:
         self._profile("get_lineage", _profile_start, time.perf_counter())
         return lineage
 
+    def get_lineages(
+        self, tax_ids: list[str], as_of: datetime | None = None
+    ) -> dict[str, list[Event]]:
+        """
+        Return the lineage (same order as `get_lineage`) of each tax ID in
+        `tax_ids` as of a single date. Ancestors shared between tax IDs are only
+        looked up once.
+        """
+        _profile_start = time.perf_counter()
+
+        lineages: dict[str, list[Event]] = {}
+
+        for tax_id in tax_ids:
+            # walk up until we reach the root or an ancestor whose lineage is
+            # already known
+            path: list[tuple[str, Event | None]] = []
+            seen_tax_ids: set[str] = set()
+
+            while tax_id not in lineages and tax_id not in seen_tax_ids:
+                seen_tax_ids.add(tax_id)
+                parent = self._get_lineage_entry(tax_id=tax_id, as_of=as_of)
+                path.append((tax_id, parent))
+
+                if parent is None or parent.parent_id is None:
+                    break
+
+                tax_id = parent.parent_id
+
+            lineage = lineages.get(tax_id, [])
+
+            for path_tax_id, parent in reversed(path):
+                lineage = [] if parent is None else [parent, *lineage]
+                lineages[path_tax_id] = lineage
+
+        self._profile("get_lineages", _profile_start, time.perf_counter())
+        return lineages
+
+    def _get_lineage_entry(self, tax_id: str, as_of: datetime | None = None) -> Event | None:
+        """Return the event describing a tax ID's place in the lineage as of a
+        given date (or None if it didn't exist yet)"""
+        if self.has_state_table:
+            # usually the current event, unless it has no parent or is a
+            # deletion or merge, which take their name from earlier events
+            state = self._get_state(tax_id=tax_id, as_of=as_of)
+            if state is None:
+                return None
+            if state.parent_id and state.event_name not in (EventName.Delete, EventName.Merge):
+                return state
+
+        events = self.get_events(tax_id=tax_id, as_of=as_of)
+
+        # find most recent event where the parent_id changed
+        parent = None
+        for event in events[::-1]:
+            if event.parent_id:
+                parent = event
+                break
+
+        if parent is not None and (
+            (parent.event_name == EventName.Delete) or (parent.event_name == EventName.Merge)
+        ):
+            last_known = next((e for e in reversed(events) if e.name), None)
+            if last_known:
+                parent = Event(
+                    event_name=parent.event_name,
+                    tax_id=parent.tax_id,
+                    version_date=parent.version_date,
+                    name=last_known.name,
+                    rank=last_known.rank,
+                    parent_id=parent.parent_id,
+                    merged_into_id=parent.merged_into_id,
+                )
+
+        return parent
+
     def get_most_recent_events(self) -> dict[str, Event]:
         """Get the most recent event (version) for each Tax ID in the database"""
 
-        rows = self.cursor.execute("""
-        SELECT * FROM taxonomy t1
-        WHERE t1.version_date = (
-            SELECT MAX(t2.version_date)
-            FROM taxonomy t2
-            WHERE t2.tax_id = t1.tax_id
+        if self.has_state_table:
+            # the most recent event of each tax ID is the one still valid
+            rows = self.conn.execute("""
+            SELECT taxonomy.*
+            FROM taxonomy_state
+            JOIN taxonomy ON taxonomy.id = taxonomy_state.event_id
+            WHERE taxonomy_state.valid_to IS NULL
+            """)
+            return {event.tax_id: event for event in self._events(rows)}
+
+        # single pass over the (tax_id, version) primary key
+        rows = self.conn.execute("SELECT * FROM taxonomy ORDER BY tax_id, version, id")
+        version_dates = self.version_dates
+        most_recent_events = {}
+        for _, tax_id_rows in groupby(rows, key=lambda r: r["tax_id"]):
+            *_, row = tax_id_rows
+            event = Event.from_row(row, version_dates)
+            most_recent_events[event.tax_id] = event
+        return most_recent_events
+
+    def iter_snapshot(self, as_of: datetime | None = None) -> Iterator[Event]:
+        """Yield the state of every tax ID that existed as of a date (or now).
+
+        Events are read in a single pass over the (tax_id, version) primary
+        key, so only the events of one tax ID are held in memory at a
+        time. Tax IDs are yielded in numeric order.
+        """
+        rows = self.conn.execute(
+            f"""SELECT *
+            FROM taxonomy
+            {"WHERE version <= ?" if as_of else ""}
+            ORDER BY tax_id, version, id""",
+            (self._version(as_of),) if as_of else (),
+        )
+
+        version_dates = self.version_dates
+        for _, tax_id_rows in groupby(rows, key=lambda r: r["tax_id"]):
+            *_, row = tax_id_rows
+            if row["event_name"] not in (EventName.Delete.value, EventName.Merge.value):
+                yield Event.from_row(row, version_dates)
+
+    def get_diff_page(
+        self, from_date: datetime, to_date: datetime, after: str | None = None, limit: int = 1000
+    ) -> tuple[list[Change], str | None]:
+        """Get the net changes (see diff.net_change) of the next `limit` tax
+        IDs (ordered by tax ID, starting after `after`) that have events after
+        from_date and up to to_date.
+
+        Returns the changes and the tax ID to pass as `after` to get the next
+        page, or None if this was the last page. Pages can have fewer than
+        `limit` changes since tax IDs that ended up unchanged are left out.
+        Raises a ValueError if `after` isn't a tax ID.
+        """
+        try:
+            after_tax_id = int(after) if after else None
+        except ValueError:
+            raise ValueError(f"Invalid tax ID: {after}") from None
+
+        from_version, to_version = self._version(from_date), self._version(to_date)
+        tax_ids = self._get_diff_tax_ids(from_version, to_version)
+
+        start = 0 if after_tax_id is None else bisect_right(tax_ids, after_tax_id)
+        page = tax_ids[start : start + limit]
+
+        rows = self.conn.execute(
+            """SELECT *
+            FROM taxonomy
+            WHERE tax_id IN (SELECT value FROM json_each(?)) AND version <= ?
+            ORDER BY tax_id, version, id""",
+            (json.dumps(page.tolist()), to_version),
         )
-        """)
+        changes = list(self._net_changes(rows, from_date))
+
+        next_after = str(page[-1]) if start + limit < len(tax_ids) else None
+        return changes, next_after
+
+    def _get_diff_tax_ids(self, from_version: int, to_version: int) -> array:
+        """Get the sorted tax IDs with events after from_version and up to
+        to_version. They're looked up once per pair of versions so that each
+        page of a diff only reads its own tax IDs."""
+        key = (self.cache_namespace(), from_version, to_version)
+        if (tax_ids := diff_tax_ids_cache.get(key)) is MISSING:
+            tax_ids = array(
+                "i",
+                (
+                    r["tax_id"]
+                    for r in self.conn.execute(
+                        """SELECT DISTINCT tax_id
+                        FROM taxonomy
+                        WHERE version > ? AND version <= ?
+                        ORDER BY tax_id""",
+                        (from_version, to_version),
+                    )
+                ),
+            )
+            diff_tax_ids_cache.set(key, tax_ids)
+        return tax_ids
+
+    def _net_changes(self, rows, from_date: datetime) -> Iterator[Change]:
+        """Yield the net change of each tax ID given all of their events up to
+        the later version, ordered by tax ID and version"""
+        version_dates = self.version_dates
+        for _, tax_id_rows in groupby(rows, key=lambda r: r["tax_id"]):
+            events = [Event.from_row(r, version_dates) for r in tax_id_rows]
+            before = next((e for e in reversed(events) if e.version_date <= from_date), None)
+            if (change := net_change(events[-1].tax_id, before, events[-1])) is not None:
+                yield change
+
+    def iter_diff(
+        self, from_date: datetime, to_date: datetime, page_size: int = 1000
+    ) -> Iterator[Change]:
+        """Yield the net changes of all tax IDs between two versions, one page
+        at a time"""
+        after = None
+        while True:
+            changes, after = self.get_diff_page(from_date, to_date, after=after, limit=page_size)
+            yield from changes
+            if after is None:
+                break
 
-        return {r["tax_id"]: Event.from_dict(dict(r)) for r in rows}
+    @cached
+    def get_diff_summary(self, from_date: datetime, to_date: datetime) -> list[dict]:
+        """Count the net changes between two versions by rank and type, reading
+        the events of all changed tax IDs in one query"""
+        from_version, to_version = self._version(from_date), self._version(to_date)
+        rows = self.conn.execute(
+            """SELECT *
+            FROM taxonomy
+            WHERE tax_id IN (
+                SELECT tax_id FROM taxonomy WHERE version > ? AND version <= ?
+            ) AND version <= ?
+            ORDER BY tax_id, version, id""",
+            (from_version, to_version, to_version),
+        )
+        counts = Counter((c.rank, c.event_name) for c in self._net_changes(rows, from_date))
+        return [
+            {"rank": rank, "event_name": event_name, "count": count}
+            for (rank, event_name), count in counts.most_common()
+        ]
+
+    def get_tree(self, as_of: datetime | None = None) -> TaxonomyTree:
+        """Get the preorder-numbered taxonomy tree as of a date (or now).
+
+        Trees are read from the tree_version table (or built from a snapshot
+        of the events without it) and the most recently used ones are kept in
+        memory.
+        """
+        if not self.has_tree_versions:
+            # dates between two versions share the earlier version's tree
+            version = len(self.version_dates) - 1 if as_of is None else self._version(as_of)
+            key = (self.cache_namespace(), "snapshot", version)
+            if (tree := tree_cache.get(key)) is MISSING:
+                tree = TaxonomyTree.from_parents(
+                    {
+                        int(e.tax_id): int(e.parent_id) if e.parent_id else int(e.tax_id)
+                        for e in self.iter_snapshot(as_of=as_of)
+                    }
+                )
+                tree_cache.set(key, tree)
+            return tree
+
+        row = self.conn.execute(
+            f"""SELECT version
+            FROM tree_version
+            {"WHERE version <= ?" if as_of else ""}
+            ORDER BY version DESC
+            LIMIT 1""",
+            (self._version(as_of),) if as_of else (),
+        ).fetchone()
+
+        # before the first version
+        if row is None:
+            return TaxonomyTree.from_parents({})
+
+        key = (self.cache_namespace(), row["version"])
+        if (tree := tree_cache.get(key)) is MISSING:
+            blobs = self.conn.execute(
+                "SELECT tax_ids, sizes, parent_offsets FROM tree_version WHERE version = ?",
+                (row["version"],),
+            ).fetchone()
+            tree = TaxonomyTree.from_blobs(*blobs)
+            tree_cache.set(key, tree)
+        return tree
+
+    def is_descendant(self, tax_id: str, ancestor_id: str, as_of: datetime | None = None) -> bool:
+        """Whether tax_id was a descendant of ancestor_id as of a date (or
+        now). Deleted and merged tax IDs aren't descendants of anything."""
+        return self.get_tree(as_of=as_of).is_descendant(tax_id, ancestor_id)
+
+    def get_descendants_page(
+        self,
+        tax_id: str,
+        as_of: datetime | None = None,
+        after: str | None = None,
+        limit: int = 1000,
+    ) -> tuple[list[str], str | None]:
+        """Get the tax IDs of the next `limit` descendants of tax_id as of a
+        date (or now), in preorder, starting after the descendant `after`.
+
+        Returns the tax IDs and the tax ID to pass as `after` to get the next
+        page, or None if this was the last page. Raises a ValueError if
+        `after` isn't a descendant of tax_id.
+        """
+        descendants = self.get_tree(as_of=as_of).descendants(tax_id, after=after)
+        page = list(islice(descendants, limit + 1))
+        next_after = page[limit - 1] if len(page) > limit else None
+        return page[:limit], next_after
+
+    def lca(self, tax_ids: list[str], as_of: datetime | None = None) -> str | None:
+        """Return the lowest common ancestor of tax IDs as of a date (or now),
+        or None if any of them didn't exist then"""
+        return self.get_tree(as_of=as_of).lca(tax_ids)
+
+    def lca_batch(
+        self, tax_id_sets: list[list[str]], as_of: datetime | None = None
+    ) -> list[str | None]:
+        """Return the lowest common ancestor of each set of tax IDs as of a
+        single date (see lca)"""
+        tree = self.get_tree(as_of=as_of)
+        return [tree.lca(tax_ids) for tax_ids in tax_id_sets]
+
+    def get_species_index(self) -> SpeciesIndex:
+        """Get the index of current species used for random sampling (built
+        once per database and data version)"""
+        database, data_version = self.cache_namespace()
+        return load_species_index(
+            self.conn,
+            database=database,
+            data_version=data_version,
+            has_lineage_versions=self.has_lineage_versions,
+        )
 
     def _get_all_events_recursive(
         self, tax_id: str, seen_tax_ids: set | None = None
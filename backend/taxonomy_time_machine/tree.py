@@ -0,0 +1,153 @@
+import os
+import sys
+import zlib
+from array import array
+from collections.abc import Iterable, Iterator, Mapping
+
+from .cache import ResultCache
+
+# trees are large (tens of MB for the full NCBI taxonomy), so only a few of
+# them are kept in memory
+tree_cache = ResultCache(maxsize=int(os.environ.get("TTM_TREE_CACHE_SIZE", "2")))
+
+
+class TaxonomyTree:
+    """Preorder (nested set) numbering of the taxonomy at one version.
+
+    Every tax ID gets a position in a preorder traversal of the tree. The
+    descendants of the tax ID at position p are exactly the positions p + 1 to
+    p + sizes[p] - 1, so ancestor tests are two comparisons and descendants
+    are a slice. Children are visited in tax ID order.
+    """
+
+    def __init__(self, tax_ids: array, sizes: array, parents: array):
+        # by position: tax ID, size of its subtree (including itself) and
+        # position of its parent (-1 for roots)
+        self.tax_ids = tax_ids
+        self.sizes = sizes
+        self.parents = parents
+
+        self.positions = array("i", [-1]) * (max(tax_ids, default=0) + 1)
+        for position, tax_id in enumerate(tax_ids):
+            self.positions[tax_id] = position
+
+    def __len__(self) -> int:
+        return len(self.tax_ids)
+
+    @classmethod
+    def from_parents(cls, parents: Mapping[int, int]) -> "TaxonomyTree":
+        """Number a tree given the parent of each tax ID. Tax IDs whose parent
+        isn't in the tree (e.g. NO_TAX_ID) or is themselves become roots."""
+        children: dict[int, list[int]] = {}
+        roots = []
+        for tax_id, parent_id in parents.items():
+            if parent_id == tax_id or parent_id not in parents:
+                roots.append(tax_id)
+            else:
+                children.setdefault(parent_id, []).append(tax_id)
+
+        tax_ids = array("i")
+        parent_positions = array("i")
+
+        stack = [(root, -1) for root in sorted(roots, reverse=True)]
+        while stack:
+            tax_id, parent_position = stack.pop()
+            position = len(tax_ids)
+            tax_ids.append(tax_id)
+            parent_positions.append(parent_position)
+
+            if tax_id in children:
+                stack.extend((child, position) for child in sorted(children[tax_id], reverse=True))
+
+        sizes = array("i", [1]) * len(tax_ids)
+        for position in range(len(tax_ids) - 1, 0, -1):
+            if (parent_position := parent_positions[position]) >= 0:
+                sizes[parent_position] += sizes[position]
+
+        return cls(tax_ids, sizes, parent_positions)
+
+    @classmethod
+    def from_blobs(cls, tax_ids: bytes, sizes: bytes, parent_offsets: bytes) -> "TaxonomyTree":
+        """Load a tree stored with to_blobs"""
+        offsets = _unpack(parent_offsets)
+        parents = array("i", (p - o if o else -1 for p, o in enumerate(offsets)))
+        return cls(_unpack(tax_ids), _unpack(sizes), parents)
+
+    def to_blobs(self) -> tuple[bytes, bytes, bytes]:
+        """Serialize the tree as compressed tax ID, size and parent offset
+        arrays. Parents are stored relative to their children's positions
+        (0 for roots), which compresses much better."""
+        parent_offsets = array(
+            "i", (0 if p < 0 else position - p for position, p in enumerate(self.parents))
+        )
+        return _pack(self.tax_ids), _pack(self.sizes), _pack(parent_offsets)
+
+    def position(self, tax_id: str) -> int:
+        """Return the position of a tax ID, or -1 if it isn't in the tree"""
+        try:
+            key = int(tax_id)
+        except ValueError:
+            return -1
+        return self.positions[key] if 0 <= key < len(self.positions) else -1
+
+    def is_descendant(self, tax_id: str, ancestor_id: str) -> bool:
+        """Whether tax_id is a (strict) descendant of ancestor_id"""
+        position, ancestor = self.position(tax_id), self.position(ancestor_id)
+        if position < 0 or ancestor < 0:
+            return False
+        return ancestor < position < ancestor + self.sizes[ancestor]
+
+    def descendants(self, tax_id: str, after: str | None = None) -> Iterator[str]:
+        """Yield all descendants of tax_id in preorder, starting after the
+        descendant `after` if given"""
+        position = self.position(tax_id)
+        if position < 0:
+            return
+
+        start, end = position + 1, position + self.sizes[position]
+        if after is not None:
+            after_position = self.position(after)
+            if not start <= after_position < end:
+                raise ValueError(f"{after} is not a descendant of {tax_id}")
+            start = after_position + 1
+
+        for descendant in range(start, end):
+            yield str(self.tax_ids[descendant])
+
+    def lca(self, tax_ids: Iterable[str]) -> str | None:
+        """Return the lowest common ancestor of tax IDs (which may be one of
+        them), or None if any of them isn't in the tree or they are in
+        different trees"""
+        lca = -1
+        for tax_id in tax_ids:
+            position = self.position(tax_id)
+            if position < 0:
+                return None
+
+            if lca < 0:
+                lca = position
+                continue
+
+            # climb from the current LCA until its subtree contains position
+            while not lca <= position < lca + self.sizes[lca]:
+                lca = self.parents[lca]
+                if lca < 0:
+                    return None
+
+        return str(self.tax_ids[lca]) if lca >= 0 else None
+
+
+def _pack(values: array) -> bytes:
+    # stored little-endian regardless of the platform
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return zlib.compress(values.tobytes())
+
+
+def _unpack(blob: bytes) -> array:
+    values = array("i")
+    values.frombytes(zlib.decompress(blob))
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
@@ -0,0 +1,55 @@
+import sqlite3
+
+from .event import EventName
+from .event_store import EventStore
+from .tree import TaxonomyTree
+
+_DELETE_CODES = {list(EventName).index(EventName.Delete), list(EventName).index(EventName.Merge)}
+
+
+def update_tree_versions(conn: sqlite3.Connection, store: EventStore | None = None) -> int:
+    """Number the tree of every version that isn't in the tree_version table
+    yet (i.e. the versions of newly loaded taxdumps). Returns the number of
+    versions added."""
+
+    if store is None:
+        store = EventStore.from_connection(conn)
+
+    (last_version,) = conn.execute("SELECT MAX(version) FROM tree_version").fetchone()
+
+    rows_by_version: list[list[int]] = [[] for _ in store.version_dates]
+    for row, version in enumerate(store.versions):
+        rows_by_version[version].append(row)
+
+    # replay all events, keeping track of the parent of every existing tax ID
+    parents: dict[int, int] = {}
+    n_added = 0
+
+    for version, rows in enumerate(rows_by_version):
+        for row in rows:
+            tax_id = store.tax_ids[row]
+            if store.event_codes[row] in _DELETE_CODES:
+                parents.pop(tax_id, None)
+            else:
+                parents[tax_id] = store.parent_ids[row]
+
+        if last_version is not None and version <= last_version:
+            continue
+
+        tree = TaxonomyTree.from_parents(parents)
+        conn.execute(
+            """INSERT INTO tree_version (version, tax_ids, sizes, parent_offsets)
+            VALUES (?, ?, ?, ?)""",
+            (version, *tree.to_blobs()),
+        )
+        conn.commit()
+        n_added += 1
+
+    return n_added
+
+
+def rebuild_tree_versions(conn: sqlite3.Connection, store: EventStore | None = None) -> int:
+    """Recompute the tree_version table from the taxonomy table. Returns the
+    number of versions."""
+    conn.execute("DELETE FROM tree_version")
+    return update_tree_versions(conn, store=store)
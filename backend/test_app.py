@@ -0,0 +1,86 @@
+import sqlite3
+from contextlib import closing
+
+import pytest
+from sqlalchemy import create_engine, text
+
+import app as app_module
+from taxonomy_time_machine.models import Base
+from taxonomy_time_machine.name_search import (
+    CREATE_FTS_TABLE,
+    CREATE_TRIGRAM_TABLE,
+    rebuild_name_search,
+)
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    database_path = tmp_path / "events.db"
+    engine = create_engine(f"sqlite:///{database_path}")
+    with engine.begin() as conn:
+        Base.metadata.create_all(conn)
+        conn.execute(text("INSERT INTO taxonomy_source VALUES (1, 'x', '2014-08-01', 0)"))
+        conn.execute(
+            text(
+                """INSERT INTO taxonomy
+                (id, taxonomy_source_id, event_name, version, tax_id, parent_id, rank, name)
+                VALUES
+                    (1, 1, 'create', 0, 1, 1, 'no rank', 'root'),
+                    (2, 1, 'create', 0, 9606, 1, 'species', 'Homo sapiens')"""
+            )
+        )
+        for statement in (CREATE_FTS_TABLE, CREATE_TRIGRAM_TABLE):
+            conn.execute(text(statement))
+        rebuild_name_search(conn)
+
+    monkeypatch.setattr(app_module, "DATABASE_PATH", str(database_path))
+    app_module.reset_connections()
+    yield app_module.app.test_client()
+    app_module.reset_connections()
+
+
+def test_etag(client):
+    response = client.get("/events?tax_id=9606")
+    assert response.status_code == 200
+    etag, _ = response.get_etag()
+    assert etag
+    assert response.cache_control.public
+    assert response.cache_control.max_age == app_module.CACHE_MAX_AGE
+
+    # conditional requests for unchanged data, also with weak ETags (e.g.
+    # from nginx)
+    for if_none_match in (f'"{etag}"', f'W/"{etag}"'):
+        response = client.get("/events?tax_id=9606", headers={"If-None-Match": if_none_match})
+        assert response.status_code == 304
+        assert response.get_etag()[0] == etag
+
+    # loading a new taxdump changes the ETag
+    with closing(sqlite3.connect(app_module.DATABASE_PATH)) as conn, conn:
+        conn.execute("INSERT INTO taxonomy_source VALUES (2, 'y', '2014-09-01', 1)")
+    response = client.get("/events?tax_id=9606", headers={"If-None-Match": f'"{etag}"'})
+    assert response.status_code == 200
+    assert response.get_etag()[0] not in (None, etag)
+
+
+def test_no_etag_for_uncacheable_endpoints(client):
+    response = client.get("/random-species")
+    assert response.status_code == 200
+    assert response.get_etag() == (None, None)
+
+    for path, body in [
+        ("/lineage/batch", {"tax_ids": ["9606"]}),
+        ("/search/batch", {"queries": ["Homo sapiens"]}),
+        ("/lca/batch", {"tax_id_sets": [["9606", "1"]]}),
+    ]:
+        response = client.post(path, json=body)
+        assert response.status_code == 200, path
+        assert response.get_etag() == (None, None)
+
+
+def test_diff_invalid_after(client):
+    response = client.get("/diff?from=2014-01-01&to=2014-09-01&after=9606")
+    assert response.status_code == 200
+    assert response.json == {"changes": [], "next": None}
+
+    response = client.get("/diff?from=2014-01-01&to=2014-09-01&after=abc")
+    assert response.status_code == 400
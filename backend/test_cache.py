@@ -0,0 +1,101 @@
+import sqlite3
+from datetime import datetime
+
+from sqlalchemy import create_engine
+
+from taxonomy_time_machine import MemoryTimeMachine, TimeMachine
+from taxonomy_time_machine.cache import MISSING, ResultCache
+from taxonomy_time_machine.models import Base
+
+
+def test_result_cache_evicts_least_recently_used():
+    cache = ResultCache(maxsize=2)
+    cache.set("a", [1])
+    cache.set("b", [2])
+    assert cache.get("a") == [1]
+
+    cache.set("c", [3])
+    assert cache.get("b") is MISSING
+    assert cache.get("a") == [1]
+    assert cache.get("c") == [3]
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (3, 1, 1)
+
+
+def test_result_cache_max_weight():
+    cache = ResultCache(maxsize=100, max_weight=5)
+    cache.set("a", [1, 2, 3])
+    cache.set("b", [1, 2, 3])
+    assert cache.get("a") is MISSING
+    assert cache.weight == 3
+
+    # too large to cache at all
+    cache.set("c", list(range(10)))
+    assert cache.get("c") is MISSING
+    assert cache.get("b") == [1, 2, 3]
+
+
+def test_cache_is_shared_and_invalidated_by_new_source(tmp_path):
+    database_path = str(tmp_path / "events.db")
+    Base.metadata.create_all(create_engine(f"sqlite:///{database_path}"))
+
+    writer = sqlite3.connect(database_path)
+    writer.execute(
+        """INSERT INTO taxonomy_source (path, version_date, version)
+        VALUES ('a', '2014-08-01 00:00:00.000000', 0)"""
+    )
+    writer.commit()
+
+    cache = ResultCache()
+    first, second = TimeMachine(database_path), TimeMachine(database_path)
+    first.cache = second.cache = cache
+
+    assert first.get_events("1") == []
+    assert second.get_events(tax_id="1") == []
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    writer.execute(
+        """INSERT INTO taxonomy_source (path, version_date, version)
+        VALUES ('b', '2014-09-01 00:00:00.000000', 1)"""
+    )
+    writer.execute(
+        """INSERT INTO taxonomy (id, taxonomy_source_id, event_name, version, tax_id, name)
+        VALUES (1, 2, 'create', 1, 1, 'root')"""
+    )
+    writer.commit()
+
+    events = second.get_events("1")
+    assert [e.version_date for e in events] == [datetime(2014, 9, 1)]
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_memory_engine_reloads_new_events(tmp_path):
+    database_path = str(tmp_path / "events.db")
+    Base.metadata.create_all(create_engine(f"sqlite:///{database_path}"))
+
+    writer = sqlite3.connect(database_path)
+    writer.execute(
+        """INSERT INTO taxonomy_source (path, version_date, version)
+        VALUES ('a', '2014-08-01 00:00:00.000000', 0)"""
+    )
+    writer.commit()
+
+    tm = MemoryTimeMachine(database_path)
+    assert tm.get_events("1") == []
+
+    writer.execute(
+        """INSERT INTO taxonomy_source (path, version_date, version)
+        VALUES ('b', '2014-09-01 00:00:00.000000', 1)"""
+    )
+    writer.execute(
+        """INSERT INTO taxonomy (id, taxonomy_source_id, event_name, version, tax_id, name)
+        VALUES (1, 2, 'create', 1, 1, 'root')"""
+    )
+    writer.commit()
+
+    # both existing and new TimeMachines see the events of the new taxdump
+    for tm in (tm, MemoryTimeMachine(database_path)):
+        events = tm.get_events("1")
+        assert [e.version_date for e in events] == [datetime(2014, 9, 1)]
+        assert tm.get_most_recent_events()["1"] == events[0]
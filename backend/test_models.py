@@ -1,8 +1,29 @@
+import sqlite3
+from contextlib import closing
 from datetime import datetime
 
 import pytest
-
-from taxonomy_time_machine import Event, EventName
+from sqlalchemy import create_engine, text
+
+from taxonomy_time_machine import Event, EventName, TimeMachine
+from taxonomy_time_machine.lineage_versions import rebuild_lineage_versions, update_lineage_versions
+from taxonomy_time_machine.load_data import (
+    diff_taxdump,
+    insert_events,
+    iter_parsed_taxdumps,
+    load_current_tax_id_to_node,
+)
+from taxonomy_time_machine.models import Base, TaxonomySource
+from taxonomy_time_machine.name_search import (
+    CREATE_FTS_TABLE,
+    CREATE_TRIGRAM_TABLE,
+    edit_distance,
+    rebuild_name_fts,
+    rebuild_name_search,
+    update_name_search,
+)
+from taxonomy_time_machine.snapshot import format_snapshot
+from taxonomy_time_machine.tree import TaxonomyTree
 
 D1 = datetime(2014, 8, 1)
 D2 = datetime(2014, 9, 1)
@@ -42,6 +63,85 @@ def test_match_should_be_deduplicated(db):
     assert len([m for m in matches if m["name"] == "Drosophila simulans"]) == 1
 
 
+def test_match_should_be_ranked_by_length(db):
+    matches = db.search_names("Drosophila", limit=2)
+    assert [m.name for m in matches] == ["Drosophila", "Drosophila simulans"]
+    # the most recent event with the name
+    assert matches[1].version_date == D2
+
+
+def test_search_names_approximate(db):
+    if not db.has_name_trigram:
+        pytest.skip("database has no name_trigram index")
+
+    # misspelled names are found by the last search stage
+    matches = db.search_names("Bacteriodes vulgatus")
+    assert matches[0].name == "Bacteroides vulgatus"
+    assert matches[0].tax_id == "821"
+
+    matches = db.search_names_approximate("drosophla melanogaster", max_distance=1)
+    assert [m.name for m in matches] == ["Drosophila melanogaster"]
+    assert db.search_names_approximate("Drosophla melanogaster", max_distance=0) == []
+    assert db.search_names_approximate("Dr") == []
+
+
+def test_search_names_approximate_common_trigrams(tmp_path, monkeypatch):
+    database_path = tmp_path / "events.db"
+    engine = create_engine(f"sqlite:///{database_path}")
+    names = [f"Streptomyces sp. {n}" for n in range(1, 31)]
+    # share some pieces of the query below, but fewer than a match needs
+    common_names = [f"Bacillales sp. {n}" for n in range(100, 1000)]
+    with engine.begin() as conn:
+        Base.metadata.create_all(conn)
+        for statement in (CREATE_FTS_TABLE, CREATE_TRIGRAM_TABLE):
+            conn.execute(text(statement))
+        conn.execute(text("INSERT INTO taxonomy_source VALUES (1, 'x', '2014-08-01', 0)"))
+        conn.execute(
+            text(
+                """INSERT INTO taxonomy (id, taxonomy_source_id, event_name, version, tax_id, name)
+                VALUES (:id, 1, 'create', 0, :id, :name)"""
+            ),
+            [{"id": id, "name": name} for id, name in enumerate(names + common_names, start=1)],
+        )
+        rebuild_name_search(conn)
+
+    compared = []
+
+    def spy_edit_distance(a, b, max_distance):
+        compared.append(b)
+        return edit_distance(a, b, max_distance)
+
+    monkeypatch.setattr("taxonomy_time_machine.time_machine.MAX_CANDIDATES", 50)
+    monkeypatch.setattr("taxonomy_time_machine.time_machine.edit_distance", spy_edit_distance)
+    tm = TimeMachine(str(database_path))
+    tm.cache = None
+
+    query = "Streptomyces sp. 12"
+    matches = tm.search_names_approximate(query, limit=None)
+
+    # only names containing enough pieces of the query are compared with it
+    assert len(compared) == len(names)
+    assert {m.name for m in matches} == {
+        name for name in names if edit_distance(query.lower(), name.lower(), 2) <= 2
+    }
+    assert matches[0].name == query
+
+
+@pytest.mark.parametrize(
+    ["a", "b", "max_distance", "expected"],
+    [
+        ("bacteroides", "bacteroides", 2, 0),
+        ("bacteriodes", "bacteroides", 2, 2),
+        ("drosophla", "drosophila", 2, 1),
+        ("kitten", "sitting", 3, 3),
+        ("kitten", "sitting", 2, 3),  # capped at max_distance + 1
+        ("a", "abcd", 1, 2),
+    ],
+)
+def test_edit_distance(a, b, max_distance, expected):
+    assert edit_distance(a, b, max_distance) == expected
+
+
 def test_get_children_deleted_node(db):
     events = db.get_events("1001")
     assert len(events) == 2
@@ -78,6 +178,9 @@ def test_get_children_deleted_node(db):
         ("2000", D1, {"MovedSpecies"}),  # before move
         ("2000", None, set()),  # after move: no children
         ("2001", None, {"MovedSpecies"}),  # new parent has the child
+        ("1100", D1, {"RecreatedSpecies"}),  # before deletion
+        ("1100", D2, set()),  # after deletion
+        ("1100", None, {"RecreatedSpecies"}),  # after re-creation
     ],
 )
 def test_children_scenarios(db, tax_id, timestamp, expected_names):
@@ -110,6 +213,19 @@ def test_get_events(db):
     assert len(events) == 2
 
 
+def test_event_from_row(db):
+    rows = db.conn.execute("SELECT * FROM taxonomy ORDER BY id").fetchall()
+    events = [Event.from_row(r, db.version_dates) for r in rows]
+    assert events == [
+        Event.from_dict({**dict(r), "version_date": db.version_dates[r["version"]]}) for r in rows
+    ]
+    assert Event.from_dict(events[0].to_dict()) == events[0]
+
+    # ranks share one string
+    species = [e.rank for e in events if e.rank == "species"]
+    assert len(species) > 1 and all(rank is species[0] for rank in species)
+
+
 def test_get_all_events_recursive(db):
     events = db.get_all_events_recursive("821")
     assert events
@@ -235,3 +351,465 @@ def test_get_versions_merged(db):
     assert len(events) == 2
     assert events[0].event_name is EventName.Create
     assert events[1].event_name is EventName.Merge
+
+
+def test_engines_match_event_history(db):
+    # the in-memory store and the derived tables must give the same answers as
+    # reading the full event history
+    sqlite_db = TimeMachine.from_connection(db.conn)
+    sqlite_db.has_state_table = False
+    sqlite_db.has_lineage_versions = False
+    sqlite_db.cache = None
+
+    tax_ids = [str(r["tax_id"]) for r in db.conn.execute("SELECT DISTINCT tax_id FROM taxonomy")]
+
+    for tax_id in tax_ids + ["404"]:
+        assert db.get_versions(tax_id) == sqlite_db.get_versions(tax_id)
+        for as_of in [None, D1, D2, D3, D4]:
+            for query_key in ["tax_id", "parent_id"]:
+                assert db.get_events(tax_id, as_of, query_key) == sqlite_db.get_events(
+                    tax_id, as_of, query_key
+                )
+            assert db.get_lineage(tax_id, as_of) == sqlite_db.get_lineage(tax_id, as_of)
+            assert db.get_children(tax_id, as_of) == sqlite_db.get_children(tax_id, as_of)
+
+    assert db.get_most_recent_events() == sqlite_db.get_most_recent_events()
+
+
+def test_get_lineages(db):
+    tax_ids = ["821", "100", "10010", "1001", "4932", "404", "821"]
+    for as_of in [None, D1, D2, D4]:
+        lineages = db.get_lineages(tax_ids, as_of=as_of)
+        assert set(lineages) >= set(tax_ids)
+        for tax_id in tax_ids:
+            assert lineages[tax_id] == db.get_lineage(tax_id, as_of=as_of)
+
+
+def test_lineage_from_state_table(db):
+    if not db.has_state_table:
+        pytest.skip("database has no taxonomy_state table")
+
+    # lineage entries looked up in taxonomy_state must match the ones found by
+    # reading each tax ID's events
+    events_db = TimeMachine.from_connection(db.conn)
+    events_db.has_state_table = False
+    events_db.cache = None
+
+    tax_ids = [str(r["tax_id"]) for r in db.conn.execute("SELECT DISTINCT tax_id FROM taxonomy")]
+
+    for tax_id in tax_ids + ["404"]:
+        for as_of in [None, datetime(2000, 1, 1), D1, datetime(2014, 8, 15), D2, D3, D4]:
+            assert db._get_lineage_entry(tax_id, as_of) == events_db._get_lineage_entry(
+                tax_id, as_of
+            )
+            assert db.get_lineage(tax_id, as_of) == events_db.get_lineage(tax_id, as_of)
+
+
+def test_search_names_batch(db):
+    queries = ["Drosophila simulans", "Saccharomyces cere", "4932", "Nothing here"]
+
+    matches = db.search_names_batch(queries, exact=True)
+    assert [m.name for m in matches["Drosophila simulans"]] == ["Drosophila simulans"]
+    assert matches["Drosophila simulans"][0].version_date == D2
+    # misses fall back to fuzzy search
+    assert matches["Saccharomyces cere"] == db.search_names("Saccharomyces cere")
+    assert matches["4932"][0].name == "Saccharomyces cerevisiae"
+    assert matches["Nothing here"] == []
+
+    matches = db.search_names_batch(queries, exact=False)
+    for query in queries:
+        assert matches[query] == db.search_names(query)
+
+
+def test_state_table_intervals(db):
+    if not db.has_state_table:
+        pytest.skip("database has no taxonomy_state table")
+
+    rows = db.conn.execute(
+        """SELECT event_name, valid_from, valid_to
+        FROM taxonomy_state
+        WHERE tax_id = '1101'
+        ORDER BY valid_from"""
+    ).fetchall()
+
+    # each event is current until the next event for the same tax ID
+    assert [r["event_name"] for r in rows] == ["create", "delete", "create"]
+    assert [r["valid_to"] for r in rows] == [rows[1]["valid_from"], rows[2]["valid_from"], None]
+
+
+@pytest.mark.parametrize("n_versions", [1, 2, 3])
+def test_update_lineage_versions(db, n_versions):
+    if not db.has_lineage_versions:
+        pytest.skip("database has no lineage_version table")
+
+    conn = sqlite3.connect(":memory:")
+    db.conn.backup(conn)
+    expected = conn.execute("SELECT * FROM lineage_version ORDER BY tax_id, version").fetchall()
+
+    # load the first versions, then the others
+    conn.execute(
+        "CREATE TABLE new_events AS SELECT * FROM taxonomy WHERE version >= ?", (n_versions,)
+    )
+    conn.execute("DELETE FROM taxonomy WHERE version >= ?", (n_versions,))
+    rebuild_lineage_versions(conn)
+    conn.execute("INSERT INTO taxonomy SELECT * FROM new_events")
+    update_lineage_versions(conn)
+
+    assert (
+        conn.execute("SELECT * FROM lineage_version ORDER BY tax_id, version").fetchall()
+        == expected
+    )
+
+
+def test_species_index(db):
+    index = db.get_species_index()
+
+    current_species = {
+        tax_id
+        for tax_id, event in db.get_most_recent_events().items()
+        if event.rank == "species" and event.event_name not in (EventName.Delete, EventName.Merge)
+    }
+    assert {str(tax_id) for tax_id in index.tax_ids} == current_species
+    assert "1001" not in current_species  # deleted
+    assert index.count() == len(current_species)
+
+    # re-created species with 3 events
+    assert index.sample(min_event_count=3) == ("1101", 3)
+    assert index.sample(min_event_count=4) is None
+
+    changed_species = {str(tax_id) for tax_id in index.changed_tax_ids}
+    assert index.sample(changed_lineage=True)[0] in changed_species
+    assert {"821", "2002"} <= changed_species  # renamed, moved
+    assert "4932" not in changed_species
+
+    if db.has_lineage_versions:
+        assert changed_species == {
+            tax_id for tax_id in current_species if len(db.get_versions(tax_id)) > 1
+        }
+
+
+def test_iter_snapshot(db):
+    snapshot = {e.tax_id: e for e in db.iter_snapshot(as_of=D1)}
+    assert snapshot["1001"].name == "DeletedSpecies"
+    assert snapshot["821"].name == "Bacteroides vulgatus"
+
+    snapshot = {e.tax_id: e for e in db.iter_snapshot()}
+    assert "1001" not in snapshot  # deleted
+    assert "10010" not in snapshot  # merged
+    assert snapshot["821"].name == "Phocaeicola vulgatus"
+    assert snapshot["1101"].name == "RecreatedSpecies"
+
+    # the same state as looking up each tax ID
+    for tax_id, event in snapshot.items():
+        assert event == db.get_events(tax_id)[-1]
+
+    lines = "".join(format_snapshot(db.iter_snapshot(as_of=D2), format="nodes")).splitlines()
+    assert "1\t|\t1\t|\tno rank\t|" + "\t\t|" * 10 in lines
+    assert len(lines) == len(list(db.iter_snapshot(as_of=D2)))
+
+
+def test_diff(db):
+    changes = {c.tax_id: c for c in db.iter_diff(D1, D4, page_size=2)}
+
+    assert changes["821"].event_name is EventName.Update
+    assert changes["821"].changed_fields == ["name"]
+    assert changes["821"].before.name == "Bacteroides vulgatus"
+    assert changes["821"].after.name == "Phocaeicola vulgatus"
+    assert changes["2002"].changed_fields == ["parent_id"]
+    assert changes["1001"].event_name is EventName.Delete
+    assert changes["1001"].rank == "species"
+    assert changes["10010"].event_name is EventName.Merge
+    # deleted and re-created with the same state: no net change
+    assert "1101" not in changes
+    assert "4932" not in changes
+
+    changes_after_deletion = {c.tax_id: c for c in db.iter_diff(D2, D3)}
+    assert changes_after_deletion["10"].changed_fields == ["name"]
+    assert changes_after_deletion["1101"].event_name is EventName.Create  # re-created
+
+    # pages are ordered by tax ID and continue where the previous one ended
+    assert list(changes) == sorted(changes, key=int)
+    assert list(db.iter_diff(D1, D4)) == list(changes.values())
+    assert db.get_diff_page(D1, D4, limit=10_000) == (list(changes.values()), None)
+    assert db.get_diff_page(D1, D4, after="99999") == ([], None)
+    with pytest.raises(ValueError):
+        db.get_diff_page(D1, D4, after="abc")
+
+    summary = db.get_diff_summary(D1, D4)
+    assert sum(s["count"] for s in summary) == len(changes)
+    assert {"rank": "species", "event_name": EventName.Delete, "count": 1} in summary
+
+
+def test_descendants(db):
+    assert db.is_descendant("2002", "2000", as_of=D1)
+    assert not db.is_descendant("2002", "2001", as_of=D1)
+    assert db.is_descendant("2002", "2001", as_of=D2)
+    assert not db.is_descendant("2002", "2000")
+    assert db.is_descendant("2002", "2")
+    assert not db.is_descendant("2", "2002")
+    assert not db.is_descendant("2002", "2002")
+
+    # deleted tax IDs aren't in the tree anymore
+    assert db.is_descendant("1001", "1000", as_of=D1)
+    assert not db.is_descendant("1001", "1000", as_of=D2)
+    assert db.get_descendants_page("1000", as_of=D1) == (["1001"], None)
+    assert db.get_descendants_page("1000", as_of=D4) == ([], None)
+    assert db.get_descendants_page("1001") == ([], None)
+    assert db.get_descendants_page("not a tax id") == ([], None)
+
+    assert db.get_descendants_page("2000", as_of=D1) == (["2002"], None)
+    assert db.get_descendants_page("2000", as_of=D2) == ([], None)
+
+    # pages continue where the previous one ended
+    descendants, _ = db.get_descendants_page("1", as_of=D4, limit=10_000)
+    assert len(descendants) == len(db.get_tree(as_of=D4)) - 1
+    page, after = db.get_descendants_page("1", as_of=D4, limit=3)
+    pages = [page]
+    while after is not None:
+        page, after = db.get_descendants_page("1", as_of=D4, after=after, limit=3)
+        pages.append(page)
+    assert [d for page in pages for d in page] == descendants
+    assert all(len(page) == 3 for page in pages[:-1])
+    with pytest.raises(ValueError, match="not a descendant"):
+        db.get_descendants_page("2000", as_of=D1, after="1001")
+
+    # the same ancestors as the lineages (which leave out the root)
+    for as_of in (D1, D2, D3, D4):
+        tree = db.get_tree(as_of=as_of)
+        snapshot = [e.tax_id for e in db.iter_snapshot(as_of=as_of)]
+        assert len(tree) == len(snapshot)
+        for tax_id in snapshot:
+            lineage = {e.tax_id for e in db.get_lineage(tax_id, as_of=as_of)[1:]}
+            ancestors = {a for a in snapshot if db.is_descendant(tax_id, a, as_of=as_of)}
+            assert ancestors - {"1"} == lineage
+
+    tree = db.get_tree()
+    loaded = TaxonomyTree.from_blobs(*tree.to_blobs())
+    assert (loaded.tax_ids, loaded.sizes, loaded.parents) == (
+        tree.tax_ids,
+        tree.sizes,
+        tree.parents,
+    )
+
+
+def test_lca(db):
+    assert db.lca(["2002", "2000"], as_of=D1) == "2000"
+    assert db.lca(["2002", "2000"], as_of=D2) == "2"
+    assert db.lca(["2002", "2001", "2000"], as_of=D2) == "2"
+    assert db.lca(["821"]) == "821"
+    assert db.lca(["821", "2"]) == "2"
+    assert db.lca(["1001", "2"], as_of=D1) is not None
+    assert db.lca(["1001", "2"], as_of=D2) is None  # deleted
+    assert db.lca([]) is None
+
+    # the deepest shared tax ID of the lineages
+    snapshot = [e.tax_id for e in db.iter_snapshot(as_of=D1)]
+    lineages = {
+        t: [t] + [e.tax_id for e in db.get_lineage(t, as_of=D1)[1:]] + ["1"] for t in snapshot
+    }
+    pairs = [[a, b] for a in snapshot for b in snapshot]
+    for (a, b), lca in zip(pairs, db.lca_batch(pairs, as_of=D1), strict=True):
+        assert lca == next(t for t in lineages[a] if t in lineages[b])
+
+
+def test_read_only_connection(tmp_path, monkeypatch):
+    database_path = tmp_path / "events.db"
+    Base.metadata.create_all(create_engine(f"sqlite:///{database_path}"))
+
+    monkeypatch.setenv("TTM_SQLITE_MMAP_SIZE", "1048576")
+    monkeypatch.setenv("TTM_SQLITE_CACHE_SIZE", "-1024")
+    tm = TimeMachine(str(database_path), read_only=True)
+
+    assert tm.conn.execute("PRAGMA mmap_size").fetchone()[0] == 1048576
+    assert tm.conn.execute("PRAGMA cache_size").fetchone()[0] == -1024
+    assert tm.conn.execute("PRAGMA temp_store").fetchone()[0] == 2  # memory
+    assert tm.get_events("1") == []
+
+    with pytest.raises(sqlite3.OperationalError, match="readonly"):
+        tm.conn.execute("INSERT INTO taxonomy_source VALUES (1, 'x', '2014-08-01', 0)")
+
+    tm.conn.rollback()
+
+    # not immutable by default: newly loaded taxdumps are seen
+    data_version = tm.data_version
+    with closing(sqlite3.connect(database_path)) as conn, conn:
+        conn.execute("INSERT INTO taxonomy_source VALUES (1, 'x', '2014-08-01', 0)")
+    assert tm.data_version != data_version
+    assert tm.version_dates == [D1]
+
+
+def _write_taxdump(path, nodes, merged=()):
+    path.mkdir()
+    with open(path / "nodes.dmp", "w") as f:
+        for tax_id, parent_id, _, rank in nodes:
+            f.write(f"{tax_id}\t|\t{parent_id}\t|\t{rank}\t|" + "\t\t|" * 10 + "\n")
+    with open(path / "names.dmp", "w") as f:
+        for tax_id, _, name, _ in nodes:
+            f.write(f"{tax_id}\t|\t{name}\t|\t\t|\tscientific name\t|\n")
+    with open(path / "merged.dmp", "w") as f:
+        for old, new in merged:
+            f.write(f"{old}\t|\t{new}\t|\n")
+    return path
+
+
+def test_diff_taxdump(tmp_path):
+    root = ("1", "1", "root", "no rank")
+    path1 = _write_taxdump(
+        tmp_path / "taxdmp_2014-08-01",
+        [root, ("2", "1", "A", "genus"), ("3", "2", "B", "species"), ("4", "2", "C", "species")],
+    )
+    path2 = _write_taxdump(
+        tmp_path / "taxdmp_2014-09-01",
+        [root, ("2", "1", "A2", "genus"), ("5", "2", "D", "species")],
+        merged=[("4", "5")],
+    )
+
+    # parsing ahead in worker processes gives the same result
+    (nodes1, merged1), (nodes2, merged2) = iter_parsed_taxdumps([path1, path2], workers=2)
+    assert list(iter_parsed_taxdumps([path1, path2])) == [(nodes1, merged1), (nodes2, merged2)]
+    assert nodes2["2"] == ("1", "genus", "A2")
+    assert merged2 == {"4": "5"}
+
+    conn = create_engine("sqlite://").connect()
+    Base.metadata.create_all(conn)
+    conn.execute(
+        TaxonomySource.__table__.insert(),
+        [
+            {"id": 1, "path": str(path1), "version_date": D1, "version": 0},
+            {"id": 2, "path": str(path2), "version_date": D2, "version": 1},
+        ],
+    )
+
+    state = {}
+    events = diff_taxdump(nodes1, merged1, state, taxdump_date=D1, taxonomy_source_id=1)
+    assert {e.event_name for e in events} == {EventName.Create}
+    assert set(state) == {"1", "2", "3", "4"}
+    insert_events(conn, events)
+
+    # a resumed import starts from the same state
+    resumed = load_current_tax_id_to_node(conn)
+    assert resumed == state
+
+    events = diff_taxdump(nodes2, merged2, resumed, taxdump_date=D2, taxonomy_source_id=2)
+    by_tax_id = {e.tax_id: e for e in events}
+    assert by_tax_id["2"].event_name is EventName.Update
+    assert by_tax_id["3"].event_name is EventName.Delete
+    assert by_tax_id["3"].parent_id == "2"
+    assert by_tax_id["4"].event_name is EventName.Merge
+    assert by_tax_id["4"].merged_into_id == "5"
+    assert by_tax_id["5"].event_name is EventName.Create
+    assert "1" not in by_tax_id
+    assert set(resumed) == {"1", "2", "5"}
+
+    insert_events(conn, events)
+    assert load_current_tax_id_to_node(conn) == resumed
+
+
+def _name_search_state(conn):
+    for table in ("name_search_fts", "name_trigram"):
+        # checks the index against the content of name_search
+        conn.execute(text(f"INSERT INTO {table}({table}, rank) VALUES ('integrity-check', 1)"))
+
+    rows = conn.execute(text("SELECT id, name, event_id FROM name_search ORDER BY id")).all()
+    # IDs are ordered by (length, name)
+    assert [name for _, name, _ in rows] == sorted(
+        (name for _, name, _ in rows), key=lambda n: (len(n), n)
+    )
+
+    fts_names = conn.execute(text("SELECT name FROM name_fts ORDER BY name")).scalars().all()
+    return {(name, event_id) for _, name, event_id in rows}, fts_names
+
+
+@pytest.mark.parametrize("legacy_numbering", [False, True])
+def test_update_name_search(legacy_numbering):
+    engine = create_engine("sqlite://")
+    conn = engine.connect()
+    Base.metadata.create_all(conn)
+    for statement in (
+        "CREATE VIRTUAL TABLE name_fts USING fts5(name)",
+        CREATE_FTS_TABLE,
+        CREATE_TRIGRAM_TABLE,
+    ):
+        conn.execute(text(statement))
+
+    def add_events(version, events):
+        conn.execute(
+            text(
+                """INSERT INTO taxonomy
+                (id, taxonomy_source_id, event_name, version, tax_id, name)
+                VALUES (
+                    (SELECT COALESCE(MAX(id), 0) + 1 FROM taxonomy),
+                    1, :event_name, :version, :tax_id, :name
+                )"""
+            ),
+            [{"event_name": e, "version": version, "tax_id": t, "name": n} for e, t, n in events],
+        )
+
+    add_events(
+        0,
+        [
+            ("create", "1", "aaa"),
+            ("create", "2", "ccc"),
+            ("create", "3", "eeee"),
+            ("create", "4", "x"),
+        ],
+    )
+    update_name_search(conn)  # empty: rebuilds
+
+    if legacy_numbering:
+        # earlier versions numbered names of the same length consecutively, so
+        # there is no room for new names between them
+        conn.execute(
+            text(
+                """UPDATE name_search SET id = (
+                    SELECT (LENGTH(n.name) << 32) | (COUNT(*) - 1)
+                    FROM name_search n
+                    WHERE LENGTH(n.name) = LENGTH(name_search.name) AND n.name <= name_search.name
+                )"""
+            )
+        )
+        for table in ("name_search_fts", "name_trigram"):
+            conn.execute(text(f"INSERT INTO {table}({table}) VALUES ('rebuild')"))
+
+    ids = dict(conn.execute(text("SELECT name, id FROM name_search")).all())
+
+    add_events(
+        1,
+        [
+            ("create", "5", "bbb"),  # between existing names
+            ("create", "6", "bbc"),
+            ("create", "7", "zzz"),  # after them
+            ("alter", "1", "aaaa"),  # renamed
+            ("create", "8", "eeee"),  # now the most recent event with this name
+            ("create", "9", "eeee"),  # same version: doesn't replace 8
+            ("create", "500", "Bacillus"),  # homonyms: the first event wins, not
+            ("create", "100", "Bacillus"),  # the smallest tax ID
+            ("delete", "4", None),
+        ],
+    )
+    assert update_name_search(conn) == 5
+
+    incremental = _name_search_state(conn)
+    if not legacy_numbering:
+        # numbered in between without renumbering the other names
+        assert (
+            conn.execute(text("SELECT id FROM name_search WHERE name = 'aaa'")).scalar()
+            == ids["aaa"]
+        )
+
+    rebuild_name_search(conn)
+    rebuild_name_fts(conn)
+    assert _name_search_state(conn) == incremental
+    assert incremental[1] == ["Bacillus", "aaa", "aaaa", "bbb", "bbc", "ccc", "eeee", "x", "zzz"]
+    assert (
+        conn.execute(
+            text(
+                """SELECT tax_id FROM name_search
+                JOIN taxonomy ON taxonomy.id = name_search.event_id
+                WHERE name_search.name IN ('eeee', 'Bacillus')
+                ORDER BY name_search.name"""
+            )
+        )
+        .scalars()
+        .all()
+    ) == [500, 8]
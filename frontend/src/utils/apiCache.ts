@@ -24,4 +24,26 @@ export async function apiFetchWithCache(url: string): Promise<any> {
   const data = await response.json();
   apiCache[url] = data;
   return data;
-}
\ No newline at end of file
+}
+
+/**
+ * POSTs a JSON body to a URL and returns the parsed JSON response. Used by the
+ * batch endpoints, whose responses are not cached.
+ * @param url The URL to POST to
+ * @param body The request body (serialized as JSON)
+ * @returns The parsed JSON response
+ */
+export async function apiPostJson(url: string, body: any): Promise<any> {
+  const response = await fetch(url, {
+    method: "POST",
+    headers: {
+      "Accept": "application/json",
+      "Content-Type": "application/json",
+    },
+    body: JSON.stringify(body),
+  });
+  if (!response.ok) {
+    throw new Error(`API request failed: ${response.status} ${response.statusText}`);
+  }
+  return response.json();
+}